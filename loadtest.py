@@ -0,0 +1,388 @@
+"""
+Load test for the bot: replays synthetic Telegram updates against its webhook and absorbs the bot's
+Bot API calls with a local fake Bot API server.
+
+1. Start the load test first, it serves the fake Bot API and waits for the bot:
+       python loadtest.py --users 2000 --rate 100 --duration 120 --seed
+2. Start the bot against the fake Bot API and a local Postgres:
+       TELEGRAM_API_URL=http://localhost:8081 DATABASE_URL=postgresql://postgres@localhost/loadtest python main.py
+
+Every simulated user starts the bot, picks a section, answers or skips questions using the buttons of the last
+keyboard the bot sent it, and now and then switches the language or starts and cancels a subscription.
+At the end it reports the throughput, the latency until the bot's first reply per kind of update, the p50/p95/p99
+latency per handler and the database queries and Bot API calls per update (from the bot's /metrics).
+"""
+import argparse, asyncio, json, os, random, time, urllib.parse
+from collections import defaultdict
+from hashlib import sha256
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Chat ids of simulated users start here, so they do not collide with real ones in a shared database
+CHAT_ID_BASE = 9_000_000_000
+
+SECTION_LABELS = ('IT. Junior +', 'IT. Middle +', 'QA/QC. Junior +', 'QA/QC. Middle +')
+# Button texts the users tap, matched by text (the msgids are shown when no translation catalog is installed)
+SKIP_BUTTON = 'Skip question'
+RESET_BUTTON = 'Yes, reset progress'
+LANGUAGE_BUTTONS = ('English', 'Русский')
+
+class FakeBotApi:
+    """Records the Bot API calls of the bot and wakes up the simulated user of the chat on every sent message."""
+    def __init__(self):
+        self.calls = defaultdict(int)  # method -> count
+        self.message_id = 0
+        self.inboxes = {}  # chat_id -> asyncio.Queue of (received_at, text, keyboard)
+        self.last_message_ids = {}  # chat_id -> id of the last sent or edited message, for callback queries
+
+    def inbox(self, chat_id):
+        queue = self.inboxes.get(chat_id)
+        if queue is None:
+            queue = self.inboxes[chat_id] = asyncio.Queue()
+        return queue
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'ITIrinaBot'}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            markup = params.get('reply_markup')
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            keyboard = None
+            if markup and 'keyboard' in markup:
+                keyboard = [button['text'] if isinstance(button, dict) else button
+                            for row in markup['keyboard'] for button in row]
+            elif markup and 'inline_keyboard' in markup:
+                keyboard = [(button['text'], button.get('callback_data'))
+                            for row in markup['inline_keyboard'] for button in row]
+            self.inbox(chat_id).put_nowait((time.monotonic(), params.get('text', ''), keyboard))
+            self.message_id += 1
+            message_id = self.last_message_ids[chat_id] = int(params.get('message_id') or self.message_id)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        return True  # deleteMessage, setWebhook, answerCallbackQuery, ...
+
+class FakeBotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def post(self, token, method):
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            params = json.loads(self.request.body or b'{}')
+        else:
+            params = {key: values[0] for key, values in urllib.parse.parse_qs(self.request.body.decode()).items()}
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'ok': True, 'result': self.api.handle(method, params)}))
+
+    get = post
+
+class PacingBucket:
+    """Spreads the updates of all simulated users to `rate` per second."""
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_at = time.monotonic()
+
+    async def wait(self):
+        now = time.monotonic()
+        self.next_at = max(self.next_at + self.interval, now)
+        if self.next_at > now:
+            await asyncio.sleep(self.next_at - now)
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def parse_metrics(text):
+    """Parse the Prometheus text format into {(name, ((label, value), ...)): value}."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, labels = series, ()
+        if '{' in series:
+            name, rest = series.split('{', 1)
+            labels = tuple(tuple(pair.split('=', 1)) for pair in rest.rstrip('}').split('",'))
+            labels = tuple((key, raw.strip('"')) for key, raw in labels)
+        samples[(name, labels)] = float(value)
+    return samples
+
+def histogram_quantile(buckets, q):
+    # buckets: [(upper bound, cumulative count)] sorted by bound, the same interpolation as Prometheus
+    total = buckets[-1][1] if buckets else 0
+    if total == 0:
+        return 0.0
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+def handler_quantiles(before, after):
+    """p50/p95/p99 and count per handler from two scrapes of bot_handler_seconds."""
+    per_handler = defaultdict(list)
+    for (name, labels), value in after.items():
+        if name != 'bot_handler_seconds_bucket':
+            continue
+        count = value - before.get((name, labels), 0)
+        labels = dict(labels)
+        per_handler[labels['handler']].append((float(labels['le']), count))
+    result = {}
+    for handler, buckets in per_handler.items():
+        merged = defaultdict(float)  # ok and error together
+        for bound, count in buckets:
+            merged[bound] += count
+        buckets = sorted(merged.items())
+        if buckets[-1][1]:
+            result[handler] = (buckets[-1][1], *(histogram_quantile(buckets, q) for q in (0.5, 0.95, 0.99)))
+    return result
+
+def series_total(samples, name):
+    return sum(value for (sample_name, _), value in samples.items() if sample_name == name)
+
+class LoadTest:
+    def __init__(self, args, api):
+        self.args = args
+        self.api = api
+        self.webhook_url = f"{args.bot_url}/webhook/{sha256(args.token.encode()).hexdigest()}"
+        self.pacing = PacingBucket(args.rate)
+        self.update_id = 0
+        self.message_id = 0
+        self.latencies = defaultdict(list)  # kind of update -> seconds until the first reply
+        self.posted = 0
+        self.failed = 0
+        self.unanswered = 0
+
+    def make_update(self, chat_id, text, callback_data=None):
+        self.update_id += 1
+        self.message_id += 1
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'username': f'load{chat_id}', 'language_code': 'en'}
+        if callback_data is not None:
+            # A tap on an inline button of the last message the bot sent or edited
+            message = {
+                'message_id': self.api.last_message_ids.get(chat_id, 0),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Load test'},
+                'text': text,
+            }
+            return {'update_id': self.update_id, 'callback_query': {
+                'id': str(self.update_id), 'from': user, 'chat_instance': str(chat_id),
+                'message': message, 'data': callback_data}}
+        message = {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': user,
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': self.update_id, 'message': message}
+
+    async def send(self, client, chat_id, text, kind, callback_data=None):
+        """Post one update and collect the bot's replies until it sends a keyboard or goes quiet."""
+        inbox = self.api.inbox(chat_id)
+        while not inbox.empty():
+            inbox.get_nowait()
+        await self.pacing.wait()
+        started = time.monotonic()
+        try:
+            response = await client.post(self.webhook_url, json=self.make_update(chat_id, text, callback_data))
+            response.raise_for_status()
+        except httpx.HTTPError:
+            self.failed += 1
+            return None
+        self.posted += 1
+        try:
+            received_at, reply_text, keyboard = await asyncio.wait_for(inbox.get(), self.args.reply_timeout)
+        except asyncio.TimeoutError:
+            self.unanswered += 1
+            return None
+        self.latencies[kind].append(received_at - started)
+        while keyboard is None:
+            try:
+                _, reply_text, keyboard = await asyncio.wait_for(inbox.get(), self.args.quiet_time)
+            except asyncio.TimeoutError:
+                break
+        return keyboard
+
+    async def simulate_user(self, client, chat_id, deadline):
+        keyboard = await self.send(client, chat_id, '/start', 'start')
+        while time.monotonic() < deadline:
+            await asyncio.sleep(random.expovariate(1 / self.args.think_time) if self.args.think_time else 0)
+            roll = random.random()
+            if roll < 0.02:
+                keyboard = await self.send(client, chat_id, '/language', 'language')
+                if keyboard:
+                    keyboard = await self.send(client, chat_id, random.choice(LANGUAGE_BUTTONS), 'language')
+            elif roll < 0.03:
+                await self.send(client, chat_id, '/subscribe', 'subscribe')
+                keyboard = await self.send(client, chat_id, 'Skip', 'subscribe')
+            elif not keyboard:
+                keyboard = await self.send(client, chat_id, '/start', 'start')
+            elif any(label in keyboard for label in SECTION_LABELS):
+                keyboard = await self.send(client, chat_id, random.choice(SECTION_LABELS), 'section')
+            elif RESET_BUTTON in keyboard:
+                keyboard = await self.send(client, chat_id, RESET_BUTTON, 'start')
+            elif any(button in keyboard for button in LANGUAGE_BUTTONS):
+                keyboard = await self.send(client, chat_id, random.choice(LANGUAGE_BUTTONS), 'language')
+            elif isinstance(keyboard[0], tuple):
+                # QUIZ_MODE=inline: (text, callback_data) buttons
+                answers = [button for button in keyboard if button[0] != SKIP_BUTTON]
+                skip = [button for button in keyboard if button[0] == SKIP_BUTTON]
+                if skip and (roll < 0.13 or not answers):
+                    keyboard = await self.send(client, chat_id, skip[0][0], 'skip', skip[0][1])
+                else:
+                    text, callback_data = random.choice(answers)
+                    keyboard = await self.send(client, chat_id, text, 'answer', callback_data)
+            else:
+                answers = [button for button in keyboard if button != SKIP_BUTTON]
+                if SKIP_BUTTON in keyboard and (roll < 0.13 or not answers):
+                    keyboard = await self.send(client, chat_id, SKIP_BUTTON, 'skip')
+                else:
+                    keyboard = await self.send(client, chat_id, random.choice(answers), 'answer')
+
+    async def scrape(self, client):
+        headers = {'Authorization': f'Bearer {self.args.metrics_token}'} if self.args.metrics_token else {}
+        response = await client.get(f'{self.args.bot_url}/metrics', headers=headers)
+        response.raise_for_status()
+        return parse_metrics(response.text)
+
+    async def wait_for_bot(self, client):
+        print(f'Waiting for the bot on {self.args.bot_url} (start it with TELEGRAM_API_URL=http://localhost:{self.args.api_port})')
+        deadline = time.monotonic() + self.args.wait_for_bot
+        while True:
+            try:
+                return await self.scrape(client)
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(1)
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.args.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            if self.args.seed:
+                # Before the bot starts, otherwise it caches the empty sections until the next version check
+                await seed_questions(self.args.seed_questions)
+            await self.wait_for_bot(client)
+            before = await self.scrape(client)
+            calls_before = sum(self.api.calls.values())
+            started = time.monotonic()
+            deadline = started + self.args.duration
+            users = []
+            for i in range(self.args.users):
+                users.append(asyncio.create_task(self.simulate_user(client, CHAT_ID_BASE + i, deadline)))
+                await asyncio.sleep(self.args.ramp_up / self.args.users)
+            await asyncio.gather(*users)
+            elapsed = time.monotonic() - started
+            after = await self.scrape(client)
+        self.report(elapsed, before, after, sum(self.api.calls.values()) - calls_before)
+
+    def report(self, elapsed, before, after, api_calls):
+        print(f'\n{self.posted} updates in {elapsed:.1f} s: {self.posted / elapsed:.1f} updates/s '
+              f'({self.failed} failed posts, {self.unanswered} without a reply within {self.args.reply_timeout} s)')
+        print('\nTime until the first reply, per kind of update (ms):')
+        print(f"  {'kind':<12}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for kind, values in sorted(self.latencies.items()):
+            print(f'  {kind:<12}{len(values):>8}' + ''.join(f'{percentile(values, q) * 1000:>10.1f}' for q in (0.5, 0.95, 0.99)))
+        print('\nHandler latency from /metrics (ms):')
+        print(f"  {'handler':<22}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for handler, (count, p50, p95, p99) in sorted(handler_quantiles(before, after).items()):
+            print(f'  {handler:<22}{int(count):>8}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{p99 * 1000:>10.1f}')
+        queries = series_total(after, 'bot_db_query_seconds_count') - series_total(before, 'bot_db_query_seconds_count')
+        pool_wait = series_total(after, 'bot_db_pool_wait_seconds_sum') - series_total(before, 'bot_db_pool_wait_seconds_sum')
+        updates = max(self.posted, 1)
+        print(f'\nDB queries per update: {queries / updates:.2f}')
+        print(f'Pool wait per update: {pool_wait / updates * 1000:.2f} ms')
+        print(f'Bot API calls per update: {api_calls / updates:.2f} '
+              f"({', '.join(f'{method}: {count}' for method, count in sorted(self.api.calls.items()))})")
+
+async def seed_questions(count):
+    """
+    Insert `count` synthetic questions with three answers into every section that has no questions yet.
+    The bot's migrations are applied first, so this also works on an empty database.
+    """
+    import asyncpg
+    from main import run_migrations
+    await run_migrations(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+    conn = await asyncpg.connect(dsn=os.environ['DATABASE_URL'])
+    try:
+        for section in ('ITJ', 'ITM', 'QAJ', 'QAM'):
+            if await conn.fetchval('SELECT 1 FROM questions WHERE section = $1 LIMIT 1', section):
+                continue
+            async with conn.transaction():
+                for n in range(count):
+                    question_id = await conn.fetchval(
+                        "INSERT INTO questions (type, section, text, text_ru) VALUES ('Technical', $1, $2, $3) RETURNING id",
+                        section, f'{section} question {n}?', f'{section} вопрос {n}?')
+                    await conn.executemany(
+                        'INSERT INTO answers (question_id, text, text_ru, is_correct, explanation, explanation_ru) '
+                        'VALUES ($1, $2, $3, $4, $5, $6)',
+                        [(question_id, f'Answer {a} to {n}', f'Ответ {a} на {n}', a == 0,
+                          f'Explanation {a}', f'Пояснение {a}') for a in range(3)])
+            print(f'Seeded {count} questions in section {section}')
+    finally:
+        await conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bot-url', default=f"http://localhost:{os.environ.get('PORT', '8443')}",
+                        help='Base URL of the bot webhook server')
+    parser.add_argument('--token', default=os.environ.get('TOKEN'), help='The bot token (defaults to $TOKEN)')
+    parser.add_argument('--metrics-token', default=os.environ.get('METRICS_TOKEN'))
+    parser.add_argument('--api-port', type=int, default=8081, help='Port of the fake Bot API server')
+    parser.add_argument('--users', type=int, default=1000, help='Simulated chats')
+    parser.add_argument('--rate', type=float, default=50, help='Updates per second across all chats')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to keep sending updates')
+    parser.add_argument('--ramp-up', type=float, default=10, help='Seconds over which the users start')
+    parser.add_argument('--think-time', type=float, default=2, help='Mean seconds a user waits between updates')
+    parser.add_argument('--reply-timeout', type=float, default=10, help='Seconds to wait for the first reply')
+    parser.add_argument('--quiet-time', type=float, default=1, help='Seconds without replies that end an update')
+    parser.add_argument('--connections', type=int, default=100, help='HTTP connections to the webhook')
+    parser.add_argument('--wait-for-bot', type=float, default=120, help='Seconds to wait for the bot to come up')
+    parser.add_argument('--seed', action='store_true', help='Add synthetic questions to empty sections ($DATABASE_URL)')
+    parser.add_argument('--seed-questions', type=int, default=20, help='Questions per seeded section')
+    args = parser.parse_args()
+    if not args.token:
+        parser.error('--token or $TOKEN is required')
+    os.environ.setdefault('TOKEN', args.token)  # main.py reads it on import, for the migrations of --seed
+
+    async def run():
+        api = FakeBotApi()
+        server = HTTPServer(tornado.web.Application(
+            [(r'/bot([^/]+)/(\w+)', FakeBotApiHandler, {'api': api})],
+            log_function=lambda handler: None,
+        ))
+        server.listen(args.api_port)
+        print(f'Fake Bot API listening on port {args.api_port}')
+        try:
+            await LoadTest(args, api).run()
+        finally:
+            server.stop()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
-from typing import Final
+from typing import Final, Optional
 from enum import Enum
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import traceback, asyncio, logging, os
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.error import RetryAfter, Forbidden, TelegramError
+import asyncio, logging, logging.handlers, os, re, sys, time, json, signal, multiprocessing, contextvars, functools, html, queue, random, atexit
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
 import asyncpg, gettext, asyncio
 # import aioredis
 from hashlib import sha256
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from question_bank import connect as connect_database, database_ssl
 
 # Load environment variables from .env file when running locally
 load_dotenv()
@@ -23,32 +32,568 @@ secure_path = sha256(os.environ['TOKEN'].encode()).hexdigest()
 # Determine the appropriate webhook URL and logging based on environment
 if HEROKU_APP_NAME:
     WEBHOOK_URL = f'https://{HEROKU_APP_NAME}.herokuapp.com/webhook/{secure_path}'
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 else:
     WEBHOOK_URL = f'{NGROK_URL}/webhook/{secure_path}'
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# A ew global variable to track if the bot is expecting an email
-waiting_for_email = {}
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO' if HEROKU_APP_NAME else 'DEBUG').upper()
+# 'json': one JSON object per line with the chat_id/section/update_id of the update, 'text': the usual readable lines
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json' if HEROKU_APP_NAME else 'text')
+# Share of the debug records kept per category (the logger name after 'bot.'), e.g. 'quiz=0.1,message=0.01'
+LOG_SAMPLE = {category.strip(): float(rate) for category, rate in
+              (item.split('=') for item in os.environ.get('LOG_SAMPLE', '').split(',') if item.strip())}
+
+# Fields of the update being handled, added to every record logged while handling it
+log_context = contextvars.ContextVar('log_context', default={})
+
+def bind_log_context(**fields):
+    # Add fields to the log context of the current update (a task gets its own copy)
+    log_context.set({**log_context.get(), **fields})
+
+class ContextFilter(logging.Filter):
+    """Copies the log context onto the record, in the task that logged it, and samples debug records per category."""
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        if record.levelno == logging.DEBUG and self.sample_rates:
+            rate = self.sample_rates.get(record.name.partition('.')[2])
+            if rate is not None and random.random() >= rate:
+                return False
+        record.context = log_context.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **getattr(record, 'context', {}),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        context = getattr(record, 'context', None)
+        if context:
+            line += ' [' + ' '.join(f'{key}={value}' for key, value in context.items()) + ']'
+        return line
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the record on the queue as it is. The stock QueueHandler formats the message before queueing it,
+    here that happens on the listener thread, so do not log arguments that are changed right after.
+    """
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """
+    Records are queued on the event loop and formatted and written to stderr by a background thread,
+    so a slow stderr never blocks the loop.
+    """
+    log_queue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(ContextFilter(LOG_SAMPLE))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)  # Writes the queued records on exit
+
+setup_logging()
+# Loggers of the update hot path, %-style arguments are only formatted for records that are written
+quiz_log = logging.getLogger('bot.quiz')
+message_log = logging.getLogger('bot.message')
+updates_log = logging.getLogger('bot.updates')
+
+# Number of worker processes serving the webhook on this dyno. Not WEB_CONCURRENCY, which Heroku sets on its own:
+# several workers need a shared state store and give up the session cache, write-behind and per-chat ordering
+# across workers, so this is only turned on deliberately.
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+PORT = int(os.environ.get('PORT', '8443'))
+WEBHOOK_PATH = f'/webhook/{secure_path}'
+
+# Where per-user conversation state (waiting for an email, the quiz to resume) is kept:
+# 'memory' for a single process, 'postgres' or 'redis' to share it between workers and dynos
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory' if BOT_WORKERS == 1 else 'postgres')
+REDIS_URL = os.environ.get('REDIS_URL')
+STATE_TTL = int(os.environ.get('STATE_TTL', '1800'))  # An abandoned email prompt or quiz to resume is forgotten after this
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', '10000'))  # Per process, for the memory backend
+# Telegram re-delivers an update when the webhook does not answer in time, these are used to process it only once
+UPDATE_DEDUP_WINDOW = int(os.environ.get('UPDATE_DEDUP_WINDOW', '10000'))  # Recent update ids remembered per process
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', '3600'))  # Seconds a claimed update id is kept in the shared store
+STATE_METRICS_INTERVAL = int(os.environ.get('STATE_METRICS_INTERVAL', '300'))
+
+# Listen for webhooks first and connect to the database and Telegram behind it, so updates that arrive
+# during a cold start are queued instead of dropped. Set to false to start everything before listening.
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+# Seconds a webhook call that arrives during a lazy startup waits for the bot to be ready, before it is answered
+# with 503 so Telegram delivers the update again (Heroku's router gives up on a request after 30 seconds)
+STARTUP_WAIT_TIMEOUT = float(os.environ.get('STARTUP_WAIT_TIMEOUT', '20'))
+# Seconds from SIGTERM until everything is closed, Heroku kills the dyno 30 seconds after SIGTERM
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', '25'))
+# Part of SHUTDOWN_TIMEOUT kept for sending the queued messages, writing the buffers and closing the pool
+SHUTDOWN_FLUSH_TIME = 5.0
+
+# Base URL of the Bot API, e.g. a local fake Bot API server when testing (defaults to https://api.telegram.org)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+
+# Outbound message limits. Telegram allows about 30 messages per second overall
+# and about one message per second in a single chat, with short bursts tolerated.
+GLOBAL_SEND_RATE = float(os.environ.get('GLOBAL_SEND_RATE', '30'))  # For the whole dyno, split between its workers
+# A reply-mode answer sends three messages (the 🌟/❗️ flash, the explanation and the next question),
+# so the burst covers a few quick answers in a row before the per-chat rate applies
+CHAT_SEND_RATE = float(os.environ.get('CHAT_SEND_RATE', '1'))
+CHAT_SEND_BURST = int(os.environ.get('CHAT_SEND_BURST', '10'))
+# Send the separator and the question as one message instead of two
+COALESCE_QUESTION_SEPARATOR = os.environ.get('COALESCE_QUESTION_SEPARATOR', 'true').lower() in ('1', 'true', 'yes')
+
+# 'reply': answers are reply keyboard buttons and every step sends new messages.
+# 'inline': answers are inline buttons and the question message is edited in place with the feedback and the next question.
+QUIZ_MODE = os.environ.get('QUIZ_MODE', 'reply')
+
+# Chat ids allowed to run admin commands such as /reload (comma separated in env)
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.environ.get('ADMIN_CHAT_IDS', '').split(',') if chat_id.strip()}
+
+# How often (in seconds) the question cache checks the content version in the database
+QUESTION_CACHE_CHECK_INTERVAL = int(os.environ.get('QUESTION_CACHE_CHECK_INTERVAL', '60'))
+
+# Size and tuning of the asyncpg connection pool
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '20'))
+# Prepared statements cached per connection, must leave room for all of QUERIES
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', '100'))
+# Idle connections above min_size are closed after this many seconds
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.environ.get('DB_MAX_INACTIVE_CONNECTION_LIFETIME', '300'))
+# Seconds before a query is cancelled, so a stuck query does not hold a connection forever
+DB_COMMAND_TIMEOUT = float(os.environ.get('DB_COMMAND_TIMEOUT', '10'))
+
+# Seconds between bulk writes of the buffered last_active_date values
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', '30'))
+
+# Write-behind for quiz progress: answers update the cached session right away and are written to Postgres
+# in batches, at the latest PROGRESS_MAX_DIRTY_AGE seconds later or once PROGRESS_MAX_DIRTY users have unwritten
+# changes. Only used with a per-process state store (one worker), since other workers would read stale progress.
+PROGRESS_WRITE_BEHIND = os.environ.get('PROGRESS_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+PROGRESS_MAX_DIRTY_AGE = float(os.environ.get('PROGRESS_MAX_DIRTY_AGE', '5'))
+PROGRESS_MAX_DIRTY = int(os.environ.get('PROGRESS_MAX_DIRTY', '1000'))
+
+# Broadcast messages per second (split between the workers of a dyno), kept below GLOBAL_SEND_RATE
+# so interactive replies still get their share, and recipients sent to before each checkpoint
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '10'))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', '100'))
+
+# Bearer token required to read /metrics, leave empty to serve the metrics without authentication
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Updates processed at the same time. Each update uses at most one pooled connection at a time,
+# so by default this matches the pool size and updates never queue up waiting for a connection.
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', DB_POOL_MAX_SIZE))
+
+# The statements run on (almost) every update, always used as QUERIES[name] so the statement text
+# never varies. asyncpg caches prepared statements per connection by text, so each is parsed and
+# planned once per pooled connection, on its first use.
+QUERIES = {
+    'load_session': """
+        SELECT u.user_id, u.language, p.section, p.current_index,
+               p.correct_answers, p.incorrect_answers, p.skipped_questions
+        FROM users u
+        LEFT JOIN LATERAL (
+            SELECT section, current_index, correct_answers, incorrect_answers, skipped_questions
+            FROM user_progress
+            WHERE user_id = u.user_id AND current_index IS NOT NULL
+            LIMIT 1
+        ) p ON TRUE
+        WHERE u.chat_id = $1
+    """,
+    'fetch_questions': """
+        SELECT 
+            q.id as question_id,
+            CASE WHEN $2 = 'ru' THEN q.text_ru ELSE q.text END as question_text,
+            a.id as answer_id,
+            CASE WHEN $2 = 'ru' THEN a.text_ru ELSE a.text END as answer_text,
+            a.is_correct,
+            CASE WHEN $2 = 'ru' THEN a.explanation_ru ELSE a.explanation END as explanation
+        FROM questions q
+        JOIN answers a ON q.id = a.question_id
+        WHERE q.section = $1
+        ORDER BY q.id, a.id
+    """,
+    # Row counts and max ids change on every insert/delete in the bank, the bank version on every import
+    'content_version': """
+        SELECT
+            (SELECT count(*) FROM questions) as question_count,
+            (SELECT coalesce(max(id), 0) FROM questions) as question_max_id,
+            (SELECT count(*) FROM answers) as answer_count,
+            (SELECT coalesce(max(id), 0) FROM answers) as answer_max_id,
+            (SELECT coalesce(max(version), 0) FROM question_bank_version) as bank_version
+    """,
+    'start_section': """
+        INSERT INTO user_progress (user_id, section, current_index)
+        VALUES ((SELECT user_id FROM users WHERE chat_id = $1), $2, 0)
+        ON CONFLICT (user_id, section) DO UPDATE SET current_index = 0
+        RETURNING user_id, current_index, correct_answers, incorrect_answers, skipped_questions
+    """,
+    # One atomic step: only counts if $3 is still the current index, and resets the section when it is completed
+    'record_answer': """
+        UPDATE user_progress p
+        SET correct_answers = CASE WHEN o.current_index + 1 < $7 THEN o.correct_answers + $4 ELSE 0 END,
+            incorrect_answers = CASE WHEN o.current_index + 1 < $7 THEN o.incorrect_answers + $5 ELSE 0 END,
+            skipped_questions = CASE WHEN o.current_index + 1 < $7 THEN o.skipped_questions + $6 ELSE 0 END,
+            current_index = CASE WHEN o.current_index + 1 < $7 THEN o.current_index + 1 END
+        FROM (
+            SELECT user_id, section, current_index, correct_answers, incorrect_answers, skipped_questions
+            FROM user_progress
+            WHERE user_id = $1 AND section = $2 AND current_index = $3
+            FOR UPDATE
+        ) o
+        WHERE p.user_id = o.user_id AND p.section = o.section
+        RETURNING p.current_index,
+                  o.correct_answers + $4 as correct_answers,
+                  o.incorrect_answers + $5 as incorrect_answers,
+                  o.skipped_questions + $6 as skipped_questions
+    """,
+    'flush_last_active': """
+        UPDATE user_details d
+        SET last_active_date = a.last_active
+        FROM unnest($1::int[], $2::timestamptz[]) AS a(user_id, last_active)
+        WHERE d.user_id = a.user_id
+    """,
+    # Written by ProgressWriter after copying the changed rows into progress_staging
+    'merge_progress': """
+        UPDATE user_progress p
+        SET current_index = s.current_index,
+            correct_answers = s.correct_answers,
+            incorrect_answers = s.incorrect_answers,
+            skipped_questions = s.skipped_questions
+        FROM progress_staging s
+        WHERE p.user_id = s.user_id AND p.section = s.section
+    """,
+    'set_language': "UPDATE users SET language = $1 WHERE chat_id = $2",
+    'create_user': "INSERT INTO users (chat_id) VALUES ($1) ON CONFLICT DO NOTHING",
+    'create_user_details': """
+        INSERT INTO user_details (user_id, first_name, last_name, username, language_code) 
+        VALUES (
+            (SELECT user_id FROM users WHERE chat_id = $1), 
+            $2, $3, $4, $5
+        ) ON CONFLICT (user_id) DO NOTHING
+    """,
+    'reset_progress': """
+        UPDATE user_progress SET current_index = NULL, correct_answers = 0, incorrect_answers = 0, skipped_questions = 0
+        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1)
+    """,
+    'get_state': """
+        SELECT value FROM conversation_state
+        WHERE chat_id = $1 AND key = $2 AND updated_at > NOW() - make_interval(secs => $3)
+    """,
+    'set_state': """
+        INSERT INTO conversation_state (chat_id, key, value) VALUES ($1, $2, $3)
+        ON CONFLICT (chat_id, key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+    """,
+    'delete_state': "DELETE FROM conversation_state WHERE chat_id = $1 AND key = $2",
+    'claim_update': "INSERT INTO processed_updates (update_id) VALUES ($1) ON CONFLICT DO NOTHING",
+}
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+class Counter:
+    """A monotonically increasing count per combination of label values, in the Prometheus text format."""
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}  # tuple of (label, value) -> count
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f'{self.name}{format_labels(key)} {value}'
+
+class Histogram:
+    """Observations (in seconds) counted into cumulative buckets per combination of label values."""
+    kind = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # tuple of (label, value) -> [counts per bucket, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{format_labels(key + (("le", bound),))} {bucket_count}'
+            yield f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {count}'
+            yield f'{self.name}_sum{format_labels(key)} {total}'
+            yield f'{self.name}_count{format_labels(key)} {count}'
+
+class Gauge:
+    """A value read when the metrics are collected."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if value is not None:
+            yield f'{self.name} {value}'
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+# Metrics of this process, served on /metrics
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.add(Histogram('bot_handler_seconds', 'Time spent in a handler, by handler and status.'))
+DB_QUERY_LATENCY = metrics.add(Histogram('bot_db_query_seconds', 'Database query time, by statement name from QUERIES.'))
+DB_QUERY_ERRORS = metrics.add(Counter('bot_db_query_errors_total', 'Failed database queries, by statement name.'))
+POOL_WAIT = metrics.add(Histogram('bot_db_pool_wait_seconds', 'Time spent waiting for a connection from the pool.'))
+TELEGRAM_LATENCY = metrics.add(Histogram('bot_telegram_call_seconds', 'Bot API call time, by method.'))
+TELEGRAM_ERRORS = metrics.add(Counter('bot_telegram_errors_total', 'Failed Bot API calls, by method and error.'))
+DUPLICATE_UPDATES = metrics.add(Counter('bot_duplicate_updates_total', 'Re-delivered updates that were dropped, by where they were caught.'))
+BROADCAST_MESSAGES = metrics.add(Counter('bot_broadcast_messages_total', 'Broadcast messages, by delivery status.'))
+QUESTION_CACHE_LOOKUPS = metrics.add(Counter('bot_question_cache_lookups_total', 'Question cache lookups, by result (hit or miss).'))
+metrics.add(Gauge('bot_db_pool_size', 'Open connections in the pool.',
+                  lambda: postgres_pool.get_size() if postgres_pool else None))
+metrics.add(Gauge('bot_db_pool_idle', 'Idle connections in the pool.',
+                  lambda: postgres_pool.get_idle_size() if postgres_pool else None))
+
+# Statement text -> name, to label the query timings
+query_names = {query: name for name, query in QUERIES.items()}
+
+def record_query(record):
+    # asyncpg query logger, called after every query with its elapsed time
+    name = query_names.get(record.query, 'other')
+    DB_QUERY_LATENCY.observe(record.elapsed, statement=name)
+    if record.exception is not None:
+        DB_QUERY_ERRORS.inc(statement=name)
+
+def instrumented(handler):
+    """Record the latency of a handler in HANDLER_LATENCY."""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        status = 'error'
+        try:
+            result = await handler(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            HANDLER_LATENCY.observe(time.monotonic() - started, handler=handler.__name__, status=status)
+    return wrapper
+
+async def setup_connection(conn):
+    # Pool init hook, runs once for every new connection
+    conn.add_query_logger(record_query)
+    if not progress_writer.enabled:
+        return
+    # Per connection staging table of the progress write-behind, emptied by every commit
+    await conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS progress_staging (
+            user_id INT, section VARCHAR(50), current_index INT,
+            correct_answers INT, incorrect_answers INT, skipped_questions INT
+        ) ON COMMIT DELETE ROWS
+    """)
+
+# The connection pool of this process, created on startup by serve
+postgres_pool = None
 
 # Create a connection pool
 async def create_pool():
     try:
-        # Heroku requires SSL connections
-        ssl_context = 'require' if "localhost" not in os.environ['DATABASE_URL'] else False
-
         pool = await asyncpg.create_pool(
             dsn=os.environ['DATABASE_URL'],
-            ssl=ssl_context,
-            min_size=1,
-            max_size=20,
+            ssl=database_ssl(os.environ['DATABASE_URL']),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            init=setup_connection,
         )
-        print("Database connection pool created successfully.")
+        logging.info("Database connection pool created")
         return pool
     except Exception as e:
-        print(f"Failed to create a connection pool: {e}")
+        logging.error(f"Failed to create a connection pool: {e}")
         return None
 
+class PoolMetrics:
+    """How long updates waited for a connection from the pool."""
+    def __init__(self):
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds):
+        self.acquired += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def reset(self):
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+pool_metrics = PoolMetrics()
+
+async def acquire_connection():
+    started = time.monotonic()
+    conn = await postgres_pool.acquire()
+    waited = time.monotonic() - started
+    pool_metrics.record_wait(waited)
+    POOL_WAIT.observe(waited)
+    return conn
+
+class UnitOfWork:
+    """
+    The database connection of one update. A pooled connection is acquired on first use only,
+    shared by everything the update does, and given back as soon as nobody is using it before
+    the bot talks to Telegram, so an update never holds more than one pool slot.
+    """
+    def __init__(self):
+        self._conn = None
+        self._users = 0  # Open db_connection() blocks using the connection
+        self.closed = False
+
+    async def acquire(self):
+        if self._conn is None:
+            self._conn = await acquire_connection()
+        self._users += 1
+        return self._conn
+
+    async def done(self):
+        self._users -= 1
+
+    async def release(self):
+        # Only between db_connection() blocks and outside of a transaction
+        if self._conn is not None and self._users == 0 and not self._conn.is_in_transaction():
+            conn, self._conn = self._conn, None
+            await postgres_pool.release(conn)
+
+    async def close(self):
+        self.closed = True
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await postgres_pool.release(conn)
+
+# The UnitOfWork of the update being processed, set by ChatOrderedUpdateProcessor
+current_unit_of_work = contextvars.ContextVar('current_unit_of_work', default=None)
+
+@asynccontextmanager
+async def unit_of_work():
+    uow = UnitOfWork()
+    token = current_unit_of_work.set(uow)
+    try:
+        yield uow
+    finally:
+        current_unit_of_work.reset(token)
+        await uow.close()
+
+@asynccontextmanager
+async def db_connection():
+    """
+    Use the connection of the current update, acquiring it if needed.
+    Outside of an update (e.g. background jobs) a connection is acquired from the pool for this block only.
+    """
+    uow = current_unit_of_work.get()
+    if uow is None or uow.closed:
+        conn = await acquire_connection()
+        try:
+            yield conn
+        finally:
+            await postgres_pool.release(conn)
+        return
+    conn = await uow.acquire()
+    try:
+        yield conn
+    finally:
+        await uow.done()
+
+async def release_connection():
+    # Give the update's connection back to the pool before slow network I/O, it is acquired again if needed
+    uow = current_unit_of_work.get()
+    if uow is not None:
+        await uow.release()
+
+async def run_migrations(migrations_path='migrations'):
+    """
+    Apply the SQL files in migrations_path that were not applied yet, in version order.
+    Files are named <version>_<name>.sql, each one runs in its own transaction and is recorded
+    in schema_migrations. An advisory lock keeps concurrently starting workers from racing.
+    :param migrations_path: Directory with the migration files.
+    """
+    conn = await connect_database()
+    try:
+        await conn.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for filename in sorted(os.listdir(migrations_path)):
+            if not filename.endswith('.sql'):
+                continue
+            version, name = filename[:-len('.sql')].split('_', 1)
+            if int(version) in applied:
+                continue
+            with open(os.path.join(migrations_path, filename), encoding='utf-8') as f:
+                sql = f.read()
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", int(version), name)
+            logging.info(f"Applied migration {filename}")
+    finally:
+        await conn.close()
+
 class Section(Enum):
     ITJ = "ITJ"
     ITM = "ITM"
@@ -68,36 +613,148 @@ button_labels = {
 
 label_to_section = {section.value: label for section, label in button_labels.items()}
 
+# Keyboards that do not depend on the user, built once (telegram objects are immutable)
+SECTION_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton(button_labels[section])] for section in Section], one_time_keyboard=True)
+SECTION_KEYBOARD_RESIZED = ReplyKeyboardMarkup(
+    [[KeyboardButton(button_labels[section])] for section in Section], one_time_keyboard=True, resize_keyboard=True)
+LANGUAGE_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("English")], [KeyboardButton("Русский")]], one_time_keyboard=True)
+
+QUESTION_SEPARATOR = "<b>• • • 📚 📚 📚 • • • </b>"
+
+SUPPORTED_LANGUAGES = ('en', 'ru')
+
+def N_(message):
+    # Mark a string for translation without translating it right away
+    return message
+
+# Reply keyboard buttons the bot reacts to, as (msgid, action, value)
+REPLY_BUTTONS = [
+    (N_("Skip question"), 'skip', None),
+    (N_("Yes, reset progress"), 'reset', None),
+    (N_("No, continue my current session"), 'resend', None),
+    (N_("No, continue where I left off"), 'continue', None),
+]
+
+# Registry of loaded gettext catalogs keyed by language code
+translations = {}
+# Translated button texts per language, e.g. button_texts['ru']['skip']
+button_texts = {}
+# Keyboard asking whether to reset the progress, per language
+reset_keyboards = {}
+# Reply text -> (action, value) per language, so matching a reply is a single lookup
+reply_actions = {}
+
+def load_translations(locale_path='locales'):
+    """
+    Load the gettext catalogs for all supported languages once and precompute the button texts.
+    Call it again to pick up updated .mo files.
+    """
+    registry = {}
+    for language_code in SUPPORTED_LANGUAGES:
+        if language_code == 'en':
+            registry[language_code] = lambda x: x  # English: return text as is
+            continue
+        # Read the .mo file directly, gettext.translation() would return its cached catalog after an update
+        mo_path = gettext.find('messages', localedir=locale_path, languages=[language_code])
+        if mo_path is not None:
+            with open(mo_path, 'rb') as mo_file:
+                registry[language_code] = gettext.GNUTranslations(mo_file).gettext
+        else:
+            logging.warning(f"No translation catalog found for language: {language_code}, falling back to English")
+            registry[language_code] = lambda x: x  # Fallback to English
+
+    texts = {}
+    actions = {}
+    keyboards = {}
+    for language_code, _ in registry.items():
+        texts[language_code] = {action: _(msgid) for msgid, action, value in REPLY_BUTTONS}
+        keyboards[language_code] = ReplyKeyboardMarkup(
+            [[KeyboardButton(texts[language_code]['reset'])], [KeyboardButton(texts[language_code]['resend'])]],
+            one_time_keyboard=True, resize_keyboard=True)
+        actions[language_code] = {_(msgid): (action, value) for msgid, action, value in REPLY_BUTTONS}
+        actions[language_code]["English"] = ('language', 'en')
+        actions[language_code]["Русский"] = ('language', 'ru')
+        for section, label in button_labels.items():
+            actions[language_code][label] = ('section', section.value)
+
+    translations.clear()
+    translations.update(registry)
+    button_texts.clear()
+    button_texts.update(texts)
+    reset_keyboards.clear()
+    reset_keyboards.update(keyboards)
+    reply_actions.clear()
+    reply_actions.update(actions)
+    logging.info(f"Loaded translations for languages: {', '.join(registry)}")
+
 def get_translation_function(language_code):
-    if language_code == 'en':
-        return lambda x: x  # English: return text as is
-    elif language_code == 'ru':
-        locale_path = 'locales'
-        try:
-            lang = gettext.translation('messages', localedir=locale_path, languages=[language_code])
-            return lang.gettext
-        except FileNotFoundError:
-            return lambda x: x  # Fallback to English
-    else:
-        return lambda x: x  # Default to English
+    if not translations:
+        load_translations()
+    return translations.get(language_code) or translations['en']  # Default to English
+
+def get_button_text(language_code, action):
+    if not button_texts:
+        load_translations()
+    return (button_texts.get(language_code) or button_texts['en'])[action]
+
+def get_reset_keyboard(language_code):
+    if not reset_keyboards:
+        load_translations()
+    return reset_keyboards.get(language_code) or reset_keyboards['en']
+
+def build_answer_keyboard(answer_texts, skip_text):
+    """
+    Two buttons per row: the answers in order, then the skip button,
+    e.g. [a1, a2], [a3, skip] for three answers.
+    """
+    buttons = [KeyboardButton(text) for text in answer_texts] + [KeyboardButton(skip_text)]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+
+def build_inline_answer_keyboard(question, skip_text):
+    """
+    One answer per row (inline buttons are narrower), then the skip button.
+    The callback data carries the ids: a:<question_id>:<answer_id> or s:<question_id>.
+    """
+    question_id = question['question_id']
+    keyboard = [[InlineKeyboardButton(answer['answer_text'], callback_data=f"a:{question_id}:{answer['answer_id']}")]
+                for answer in question['answers']]
+    keyboard.append([InlineKeyboardButton(skip_text, callback_data=f"s:{question_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+ANSWER_CALLBACK = re.compile(r'(?:a:(\d+):(\d+)|s:(\d+))')
+
+def parse_answer_callback(data):
+    """
+    Parse the callback data of build_inline_answer_keyboard.
+    :return: ('a', question_id, answer_id), ('s', question_id, None), or None when the data is malformed.
+    """
+    match = ANSWER_CALLBACK.fullmatch(data or '')
+    if match is None:
+        return None
+    if match.group(3) is not None:
+        return 's', int(match.group(3)), None
+    return 'a', int(match.group(1)), int(match.group(2))
+
+def normalize_answer_text(text):
+    # Ignore case and repeated or surrounding whitespace, for answers typed instead of tapped
+    return ' '.join(text.split()).casefold()
+
+def get_reply_action(language_code, text):
+    """
+    Match a reply keyboard text against the precomputed buttons of the user's language.
+    :return: A tuple (action, value), or (None, None) if the text is not one of our buttons.
+    """
+    if not reply_actions:
+        load_translations()
+    actions = reply_actions.get(language_code) or reply_actions['en']
+    return actions.get(text, (None, None))
 
 # Modify fetch_questions to accept language_code and fetch appropriate text
 async def fetch_questions(conn, section, language_code):
     # Fetch all questions and their answers for a given section and language
     logging.debug(f"Querying for section: {section} and language: {language_code}")
-    questions_data = await conn.fetch("""
-        SELECT 
-            q.id as question_id,
-            CASE WHEN $2 = 'ru' THEN q.text_ru ELSE q.text END as question_text,
-            a.id as answer_id,
-            CASE WHEN $2 = 'ru' THEN a.text_ru ELSE a.text END as answer_text,
-            a.is_correct,
-            CASE WHEN $2 = 'ru' THEN a.explanation_ru ELSE a.explanation END as explanation
-        FROM questions q
-        JOIN answers a ON q.id = a.question_id
-        WHERE q.section = $1
-        ORDER BY q.id, a.id
-    """, section, language_code)
+    questions_data = await conn.fetch(QUERIES['fetch_questions'], section, language_code)
     logging.debug(f"Executed query for section: {section} with result count: {len(questions_data)}")
 
     # Organize data into a structured format for easier processing in quiz handling
@@ -117,90 +774,713 @@ async def fetch_questions(conn, section, language_code):
             'explanation': row['explanation']
         })
 
+    # Build what send_question sends once per question, instead of on every send,
+    # and the index handle_quiz resolves the chosen answer with
+    skip_text = get_button_text(language_code, 'skip')
+    for question in questions.values():
+        question['answers_by_text'] = {}
+        for answer in question['answers']:
+            question['answers_by_text'].setdefault(normalize_answer_text(answer['answer_text']), answer)
+        question['answers_by_id'] = {answer['answer_id']: answer for answer in question['answers']}
+        question['reply_markup'] = build_answer_keyboard([answer['answer_text'] for answer in question['answers']], skip_text)
+        question['inline_markup'] = build_inline_answer_keyboard(question, skip_text)
+        question['text'] = f"🧩 {question['question_text']}"
+        question['text_with_separator'] = f"{QUESTION_SEPARATOR}\n\n{question['text']}"
+
     return list(questions.values())
 
+# In-process question bank cache keyed by (section, language_code).
+# The bank only changes when content is edited, so it is loaded once and
+# dropped as a whole when the content version in the database changes.
+question_cache = {}
+question_cache_version = None
+question_cache_checked_at = 0.0
+
+async def fetch_content_version(conn):
+    row = await conn.fetchrow(QUERIES['content_version'])
+    return tuple(row)
+
+async def get_questions(conn, section, language_code):
+    """
+    Return the questions for a section and language from the in-process cache.
+    The content version is re-checked at most once per QUESTION_CACHE_CHECK_INTERVAL,
+    so on the hot path this does not touch the database at all.
+    :param conn: The database connection object used on a cache miss or version check, or None to use the update's connection only when needed.
+    :param section: The section value, e.g. 'QAJ'.
+    :param language_code: The language code, 'en' or 'ru'.
+    :return: A list of question dictionaries as built by fetch_questions.
+    """
+    global question_cache_version, question_cache_checked_at
+    now = time.monotonic()
+    key = (section, language_code)
+    version_check_due = now - question_cache_checked_at >= QUESTION_CACHE_CHECK_INTERVAL
+    if conn is None and (version_check_due or key not in question_cache):
+        async with db_connection() as conn:
+            return await get_questions(conn, section, language_code)
+
+    if version_check_due:
+        question_cache_checked_at = now
+        version = await fetch_content_version(conn)
+        if version != question_cache_version:
+            if question_cache_version is not None:
+                logging.info(f"Question bank version changed from {question_cache_version} to {version}, dropping cache")
+            question_cache.clear()
+            # An import may have moved users to another position, so cached sessions are loaded again too
+            sessions.clear()
+            question_cache_version = version
+
+    questions = question_cache.get(key)
+    QUESTION_CACHE_LOOKUPS.inc(result='miss' if questions is None else 'hit')
+    if questions is None:
+        questions = await fetch_questions(conn, section, language_code)
+        question_cache[key] = questions
+        logging.debug(f"Cached {len(questions)} questions for section: {section} and language: {language_code}")
+    return questions
+
+def invalidate_question_cache():
+    global question_cache_version, question_cache_checked_at
+    question_cache.clear()
+    question_cache_version = None
+    question_cache_checked_at = 0.0
+
+# Size and idle lifetime (in seconds) of the per-user session cache
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', '600'))
+
+class TTLCache:
+    """
+    A least recently used cache with a time to live per entry.
+    Entries expire TTL seconds after they were last written, and the least recently
+    used entry is evicted once the cache holds more than max_size entries.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def purge_expired(self):
+        """Drop the expired entries that were never read again."""
+        now = time.monotonic()
+        stale = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in stale:
+            del self._entries[key]
+        self.expired += len(stale)
+        return len(stale)
+
+    def __len__(self):
+        return len(self._entries)
+
+@dataclass
+class Session:
+    """Per-user state needed on every update, mirrored from the users and user_progress tables."""
+    chat_id: int
+    user_id: Optional[int]
+    language: str = 'en'
+    section: Optional[str] = None
+    index: Optional[int] = None
+    correct: int = 0
+    incorrect: int = 0
+    skipped: int = 0
+
+    def set_progress(self, section, row):
+        # Apply a user_progress row returned by a write
+        self.section = section
+        self.index = row['current_index']
+        self.correct = row['correct_answers']
+        self.incorrect = row['incorrect_answers']
+        self.skipped = row['skipped_questions']
+
+# chat_id -> Session. Writes go to Postgres first and are then applied here (write-through).
+sessions = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+async def load_session(conn, chat_id):
+    # One round trip for the user, language and the active quiz (if any)
+    row = await conn.fetchrow(QUERIES['load_session'], chat_id)
+    if row is None:
+        return Session(chat_id=chat_id, user_id=None)
+    session = Session(chat_id=chat_id, user_id=row['user_id'], language=row['language'] or 'en')  # Default to English
+    if row['section'] is not None:
+        session.set_progress(row['section'], row)
+    return session
+
+async def get_session(chat_id, conn=None):
+    """
+    Return the cached session for a chat, loading it from the database on a miss.
+    :param chat_id: The chat ID of the user.
+    :param conn: An already acquired connection to use on a miss, otherwise the update's connection is used.
+    :return: The Session of the user.
+    """
+    session = sessions.get(chat_id)
+    if session is None:
+        if conn is None:
+            async with db_connection() as conn:
+                session = await load_session(conn, chat_id)
+        else:
+            session = await load_session(conn, chat_id)
+        # Progress not written to the database yet is newer than what was just loaded
+        progress_writer.apply_pending(session)
+        sessions.set(chat_id, session)
+    return session
+
+def drop_session(chat_id):
+    # Forget the cached session so it is loaded again from the database on next use
+    sessions.pop(chat_id)
+
+class MemoryStateStore:
+    """
+    Conversation state kept in this process. Only suitable when a single process serves the bot.
+    Entries expire after ttl seconds, and the least recently used are evicted above max_entries.
+    """
+    shared = False
+
+    def __init__(self, max_entries=STATE_MAX_ENTRIES, ttl=STATE_TTL):
+        self._data = TTLCache(max_entries, ttl)
+
+    async def setup(self):
+        pass
+
+    async def get(self, chat_id, key):
+        return self._data.get((chat_id, key))
+
+    async def set(self, chat_id, key, value):
+        self._data.set((chat_id, key), value)
+
+    async def delete(self, chat_id, key):
+        self._data.pop((chat_id, key))
+
+    async def claim_update(self, update_id):
+        return True  # One process sees every update, the webhook's window already caught the duplicates
+
+    async def purge_expired(self):
+        return self._data.purge_expired()
+
+    async def stats(self):
+        return {'entries': len(self._data), 'expired': self._data.expired, 'evicted': self._data.evicted}
+
+class PostgresStateStore:
+    """Conversation state in the conversation_state table, shared by all workers and dynos."""
+    shared = True
+
+    async def setup(self):
+        pass  # The conversation_state table is created by a migration
+
+    def __init__(self, ttl=STATE_TTL):
+        self.ttl = ttl
+        self.expired = 0
+
+    async def get(self, chat_id, key):
+        async with db_connection() as conn:
+            value = await conn.fetchval(QUERIES['get_state'], chat_id, key, self.ttl)
+        return None if value is None else json.loads(value)
+
+    async def set(self, chat_id, key, value):
+        async with db_connection() as conn:
+            await conn.execute(QUERIES['set_state'], chat_id, key, json.dumps(value))
+
+    async def delete(self, chat_id, key):
+        async with db_connection() as conn:
+            await conn.execute(QUERIES['delete_state'], chat_id, key)
+
+    async def claim_update(self, update_id):
+        # True for the first worker to see the update id
+        async with db_connection() as conn:
+            result = await conn.execute(QUERIES['claim_update'], update_id)
+        return result == 'INSERT 0 1'
+
+    async def purge_expired(self):
+        async with db_connection() as conn:
+            await conn.execute(
+                "DELETE FROM processed_updates WHERE received_at <= NOW() - make_interval(secs => $1)", UPDATE_DEDUP_TTL)
+            result = await conn.execute(
+                "DELETE FROM conversation_state WHERE updated_at <= NOW() - make_interval(secs => $1)", self.ttl)
+        purged = int(result.split()[-1])
+        self.expired += purged
+        return purged
+
+    async def stats(self):
+        async with db_connection() as conn:
+            entries = await conn.fetchval("SELECT COUNT(*) FROM conversation_state")
+        # Only the rows purged by this worker are counted as expired, the other workers purge too
+        return {'entries': entries, 'expired': self.expired, 'evicted': 0}
+
+class RedisStateStore:
+    """Conversation state in Redis, shared by all workers and dynos."""
+    shared = True
+
+    def __init__(self, url, ttl=STATE_TTL):
+        self.ttl = ttl
+        # redis-py 4.2+ (the standalone aioredis package fails to import on Python 3.11)
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url, decode_responses=True)
+
+    async def setup(self):
+        await self._redis.ping()
+
+    async def get(self, chat_id, key):
+        value = await self._redis.get(f'state:{chat_id}:{key}')
+        return None if value is None else json.loads(value)
+
+    async def set(self, chat_id, key, value):
+        await self._redis.set(f'state:{chat_id}:{key}', json.dumps(value), ex=self.ttl)
+
+    async def delete(self, chat_id, key):
+        await self._redis.delete(f'state:{chat_id}:{key}')
+
+    async def claim_update(self, update_id):
+        # True for the first worker to see the update id
+        return bool(await self._redis.set(f'update:{update_id}', 1, nx=True, ex=UPDATE_DEDUP_TTL))
+
+    async def purge_expired(self):
+        return 0  # Redis expires the keys itself
+
+    async def stats(self):
+        entries = 0
+        async for _ in self._redis.scan_iter(match='state:*', count=1000):
+            entries += 1
+        return {'entries': entries, 'expired': 0, 'evicted': 0}
+
+async def create_state_store():
+    if STATE_BACKEND == 'postgres':
+        store = PostgresStateStore()
+    elif STATE_BACKEND == 'redis':
+        store = RedisStateStore(REDIS_URL)
+    else:
+        store = MemoryStateStore()
+    await store.setup()
+    logging.info(f"Using {STATE_BACKEND} conversation state store")
+    return store
+
+# Replaced by the configured store on startup
+state_store = MemoryStateStore()
+
+async def report_state_metrics():
+    """
+    Periodically purge expired conversation state and log the entry counts of the state store and session cache,
+    and the connection pool usage since the last report.
+    """
+    while True:
+        await asyncio.sleep(STATE_METRICS_INTERVAL)
+        try:
+            purged = await state_store.purge_expired()
+            stats = await state_store.stats()
+            logging.info(
+                f"Conversation state: {stats['entries']} entries ({purged} purged, {stats['expired']} expired, "
+                f"{stats['evicted']} evicted in total); sessions: {len(sessions)} cached "
+                f"({sessions.expired} expired, {sessions.evicted} evicted)")
+            average_wait = pool_metrics.wait_total / pool_metrics.acquired if pool_metrics.acquired else 0.0
+            logging.info(
+                f"Connection pool: {postgres_pool.get_size()} connections ({postgres_pool.get_idle_size()} idle); "
+                f"{pool_metrics.acquired} acquired, waited {average_wait * 1000:.1f} ms on average, "
+                f"{pool_metrics.wait_max * 1000:.1f} ms at most")
+            pool_metrics.reset()
+        except Exception as e:
+            logging.error(f"Error reporting conversation state metrics: {e}")
+
+class ActivityBuffer:
+    """
+    Last activity per user, kept in memory and written to user_details.last_active_date
+    in one statement per flush instead of one write per message.
+    """
+    def __init__(self):
+        self._pending = {}  # user_id -> datetime of the last message
+
+    def touch(self, user_id):
+        if user_id is not None:
+            self._pending[user_id] = datetime.now(timezone.utc)
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            async with db_connection() as conn:
+                await conn.execute(QUERIES['flush_last_active'], list(pending), list(pending.values()))
+        except Exception:
+            # Keep the values for the next flush, unless the user was active again in the meantime
+            for user_id, last_active in pending.items():
+                self._pending.setdefault(user_id, last_active)
+            raise
+        return len(pending)
+
+    async def run(self, interval=ACTIVITY_FLUSH_INTERVAL):
+        """Flush periodically until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                flushed = await self.flush()
+                logging.debug(f"Flushed the last activity of {flushed} users")
+            except Exception as e:
+                logging.error(f"Error flushing the last activity: {e}")
+
+activity = ActivityBuffer()
+
+class ProgressWriter:
+    """
+    Write-behind for user_progress. Answers are applied to the cached session and remembered as dirty,
+    and the dirty rows are written in one transaction: COPY into the progress_staging temp table, then
+    one UPDATE merging it into user_progress. A user has at most one dirty row, because starting or
+    resetting a section writes the user's pending changes first.
+    """
+    def __init__(self, max_age=PROGRESS_MAX_DIRTY_AGE, max_dirty=PROGRESS_MAX_DIRTY):
+        self.enabled = False  # Turned on at startup when PROGRESS_WRITE_BEHIND is set and state is not shared
+        self.max_age = max_age
+        self.max_dirty = max_dirty
+        self._dirty = {}  # user_id -> (section, current_index, correct, incorrect, skipped)
+        self._writing = {}  # The rows of the flush in progress, until its transaction has committed
+        self._lock = None  # A user's row is never written by two flushes at once
+        self._full = None  # Set when max_dirty rows are waiting
+
+    def _create_primitives(self):
+        # Created on first use, so they belong to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._full = asyncio.Event()
+
+    def record_answer(self, session, section_str, question_count, outcome):
+        """
+        The in-memory counterpart of record_answer (same arguments and result, without the connection).
+        """
+        if session.section != section_str or session.index is None:
+            return None
+        correct = session.correct + int(outcome == 'correct')
+        incorrect = session.incorrect + int(outcome == 'incorrect')
+        skipped = session.skipped + int(outcome == 'skipped')
+        if session.index + 1 < question_count:
+            session.index += 1
+            session.correct, session.incorrect, session.skipped = correct, incorrect, skipped
+        else:
+            # The section is completed, its counters are reset
+            session.index = None
+            session.correct = session.incorrect = session.skipped = 0
+        self._dirty[session.user_id] = (section_str, session.index, session.correct, session.incorrect, session.skipped)
+        self._create_primitives()
+        if len(self._dirty) >= self.max_dirty:
+            self._full.set()
+        return {'current_index': session.index, 'correct_answers': correct,
+                'incorrect_answers': incorrect, 'skipped_questions': skipped}
+
+    def apply_pending(self, session):
+        # A session loaded while a flush is running reads the rows from before it, so the written rows count too
+        pending = self._dirty.get(session.user_id) or self._writing.get(session.user_id)
+        if pending is not None:
+            session.section, session.index, session.correct, session.incorrect, session.skipped = pending
+
+    async def flush(self, user_id=None):
+        """
+        Write the dirty rows, or only the one of user_id.
+        :return: The number of rows written.
+        """
+        self._create_primitives()
+        async with self._lock:
+            if user_id is not None:
+                pending = {user_id: self._dirty.pop(user_id)} if user_id in self._dirty else {}
+            else:
+                pending, self._dirty = self._dirty, {}
+                self._full.clear()
+            if not pending:
+                return 0
+            records = [(user_id, *row) for user_id, row in pending.items()]
+            self._writing = pending
+            try:
+                async with db_connection() as conn, conn.transaction():
+                    await conn.copy_records_to_table('progress_staging', records=records)
+                    await conn.execute(QUERIES['merge_progress'])
+            except Exception:
+                # Keep the rows for the next flush, unless the user answered again in the meantime
+                for user_id, row in pending.items():
+                    self._dirty.setdefault(user_id, row)
+                raise
+            finally:
+                self._writing = {}
+            return len(records)
+
+    async def flush_user(self, user_id):
+        # Before a write-through change of the user's progress, so the older pending row cannot overwrite it
+        if self.enabled and user_id is not None:
+            await self.flush(user_id)
+
+    async def run(self):
+        """Flush every max_age seconds, or earlier when max_dirty rows are waiting, until cancelled."""
+        self._create_primitives()
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_age)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                written = await self.flush()
+                if written:
+                    logging.debug(f"Wrote the progress of {written} users")
+            except Exception as e:
+                logging.error(f"Error writing the progress: {e}")
+                await asyncio.sleep(1)
+
+progress_writer = ProgressWriter()
+
+# Fire-and-forget tasks that must not hold up a handler, e.g. ephemeral feedback messages
+background_tasks = set()
+
+def run_in_background(coro, name=None):
+    """
+    Schedule a coroutine without waiting for it.
+    Errors are logged instead of being lost, and pending tasks are finished or cancelled on shutdown.
+    """
+    task = asyncio.create_task(detached(coro), name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+    return task
+
+async def detached(coro):
+    # Background tasks outlive the update, so they acquire their own connections instead of sharing its one
+    current_unit_of_work.set(None)
+    return await coro
+
+def background_task_done(task):
+    background_tasks.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logging.error(f"Background task {task.get_name()} failed: {exc}")
+
+async def finish_background_tasks(timeout=2.0):
+    # Give running tasks a short grace period, then cancel whatever is left
+    if not background_tasks:
+        return
+    done, pending = await asyncio.wait(set(background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        logging.warning(f"Cancelled {len(pending)} background tasks on shutdown")
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to `capacity` operations."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        # Stop handing out tokens for a while, e.g. after Telegram answered with RetryAfter
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+class MessageDispatcher:
+    """
+    Sends outbound Bot API calls through a global and a per-chat token bucket.
+    Calls for the same chat are made one at a time in the order they were submitted,
+    and a RetryAfter (HTTP 429) from Telegram pauses all sending before the call is retried.
+    """
+    # Calls that do not add a message to the chat, so they only count against the global limit
+    CHAT_LIMIT_EXEMPT = frozenset({'delete_message', 'edit_message_text'})
+
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # Buckets outlive the chat queues so a chat cannot reset its limit by pausing briefly
+        self.chat_buckets = TTLCache(SESSION_CACHE_SIZE, max(60, chat_burst / chat_rate))
+        self.queues = {}  # chat_id -> deque of (future, method, kwargs)
+        self.workers = {}  # chat_id -> task draining the chat's queue
+
+    def submit(self, chat_id, method, /, **kwargs):
+        """
+        Queue a Bot API call for a chat without waiting for it.
+        :return: A future with the result of the call.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(chat_id, deque()).append((future, method, kwargs))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._run_chat(chat_id), name=f"dispatcher-{chat_id}")
+        return future
+
+    async def send(self, chat_id, method, /, **kwargs):
+        return await self.submit(chat_id, method, **kwargs)
+
+    async def _run_chat(self, chat_id):
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                future, method, kwargs = queue.popleft()
+                if future.done():
+                    continue
+                try:
+                    result = await self._call(chat_id, method, kwargs)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            del self.queues[chat_id]
+            del self.workers[chat_id]
+
+    async def _call(self, chat_id, method, kwargs):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self.chat_buckets.set(chat_id, bucket)
+        counted = method.__name__ not in self.CHAT_LIMIT_EXEMPT
+        for attempt in range(self.max_retries + 1):
+            if counted:
+                await bucket.acquire()
+            await self.global_bucket.acquire()
+            started = time.monotonic()
+            try:
+                result = await method(**kwargs)
+                TELEGRAM_LATENCY.observe(time.monotonic() - started, method=method.__name__)
+                return result
+            except Exception as e:
+                TELEGRAM_LATENCY.observe(time.monotonic() - started, method=method.__name__)
+                TELEGRAM_ERRORS.inc(method=method.__name__, error=type(e).__name__)
+                if not isinstance(e, RetryAfter) or attempt == self.max_retries:
+                    raise
+                logging.warning(f"Flood control for chat_id={chat_id}, retrying {method.__name__} in {e.retry_after} seconds")
+                self.global_bucket.block(e.retry_after)
+
+    async def drain(self, timeout):
+        # Wait for the queued calls of all chats to be sent
+        # :return: About how many messages were dropped
+        if not self.workers:
+            return 0
+        done, pending = await asyncio.wait(set(self.workers.values()), timeout=timeout)
+        dropped = 0
+        if pending:
+            dropped = sum(len(queue) for queue in self.queues.values()) + len(pending)
+            logging.warning(f"Dropping about {dropped} outbound messages that could not be sent in time")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return dropped
+
+dispatcher = MessageDispatcher(GLOBAL_SEND_RATE / BOT_WORKERS, CHAT_SEND_RATE, CHAT_SEND_BURST)
+
+async def send_message(bot, chat_id, text, **kwargs):
+    await release_connection()
+    return await dispatcher.send(chat_id, bot.send_message, chat_id=chat_id, text=text, **kwargs)
+
+async def reply(update, context, text, **kwargs):
+    # Same as update.message.reply_text, but sent through the outbound dispatcher
+    return await send_message(context.bot, update.effective_chat.id, text, **kwargs)
+
+async def edit_message(bot, chat_id, message_id, text, **kwargs):
+    await release_connection()
+    return await dispatcher.send(chat_id, bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+async def answer_callback(query, text=None):
+    # Stops the loading indicator on the tapped button, optionally showing a short notification
+    await release_connection()
+    try:
+        await query.answer(text)
+    except TelegramError as e:
+        logging.debug(f"Could not answer callback query {query.id}: {e}")
+
+def flash_message(bot, chat_id, text, duration=0.5):
+    """
+    Show a message for a moment and delete it again without waiting for either.
+    The message is queued right away, so it keeps its place before the messages sent after it.
+    """
+    sent = dispatcher.submit(chat_id, bot.send_message, chat_id=chat_id, text=text)
+
+    async def delete_later():
+        sent_message = await sent
+        await asyncio.sleep(duration)
+        await dispatcher.send(chat_id, bot.delete_message, chat_id=chat_id, message_id=sent_message.message_id)
+
+    return run_in_background(delete_later(), name=f"feedback-{chat_id}")
+
 # Commands
+@instrumented
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     logging.debug(f"start_command called with chat_id={chat_id}")
 
-# Retrieve user's language preference from the database
-    async with postgres_pool.acquire() as conn:
-        user_language = await conn.fetchval("""
-            SELECT language FROM users WHERE chat_id = $1
-        """, chat_id)
-        if not user_language:
-            user_language = 'en'  # Default to English
-        context.user_data['language_code'] = user_language
-
-    _ = get_translation_function(user_language)
+    # Retrieve user's language preference from the session
+    session = await get_session(chat_id)
+    _ = get_translation_function(session.language)
 
-    # Get a connection from the pool
-    async with postgres_pool.acquire() as conn:
-        # Check if the user has ongoing progress
-        active_section = await check_active_quiz(conn, chat_id)
+    # Check if the user has ongoing progress
+    active_section = await check_active_quiz(chat_id)
 
-        if active_section:
-            # User has ongoing progress, ask if they want to reset it
-            logging.debug(f"User {chat_id} has ongoing progress: {active_section}")
-            keyboard = [
-                [KeyboardButton(_("Yes, reset progress"))],
-                [KeyboardButton(_("No, continue my current session"))]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-            await update.message.reply_text(
-                _("Heads up! Starting a new session will reset your progress. Would you like to proceed?"),
-                reply_markup=reply_markup
-            )
-        else:
-            # No existing progress, proceed as before
-            logging.debug(f"No ongoing progress found for user {chat_id}")
-            await reset_and_start_new_session(conn, chat_id, update, context)
+    if active_section:
+        # User has ongoing progress, ask if they want to reset it
+        logging.debug(f"User {chat_id} has ongoing progress: {active_section}")
+        await reply(update, context,
+            _("Heads up! Starting a new session will reset your progress. Would you like to proceed?"),
+            reply_markup=get_reset_keyboard(session.language)
+        )
+    else:
+        # No existing progress, proceed as before
+        logging.debug(f"No ongoing progress found for user {chat_id}")
+        await reset_and_start_new_session(chat_id, update, context)
 
-async def reset_and_start_new_session(conn, chat_id, update, context: ContextTypes.DEFAULT_TYPE):
+async def reset_and_start_new_session(chat_id, update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-        # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
-
-    _ = get_translation_function(language_code)
+    session = await get_session(chat_id)
+    _ = get_translation_function(session.language)
     try:
-        async with conn.transaction():  # Handle transactions
-            await conn.execute("INSERT INTO users (chat_id) VALUES ($1) ON CONFLICT DO NOTHING", (chat_id))
-            await conn.execute("""
-            INSERT INTO user_details (user_id, first_name, last_name, username, language_code) 
-            VALUES (
-                (SELECT user_id FROM users WHERE chat_id = $1), 
-                $2, $3, $4, $5
-            ) ON CONFLICT (user_id) DO NOTHING
-        """, chat_id, user.first_name, user.last_name, user.username, user.language_code)
-            await conn.execute("""
-                UPDATE user_progress SET current_index = NULL, correct_answers = 0, incorrect_answers = 0, skipped_questions = 0
-                WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1)
-            """, (chat_id))
+        await progress_writer.flush_user(session.user_id)
+        async with db_connection() as conn, conn.transaction():  # Handle transactions
+            await conn.execute(QUERIES['create_user'], chat_id)
+            await conn.execute(QUERIES['create_user_details'],
+                chat_id, user.first_name, user.last_name, user.username, user.language_code)
+            await conn.execute(QUERIES['reset_progress'], chat_id)
+        # The user may have just been created and the progress was reset, load the session again on next use
+        drop_session(chat_id)
     except Exception as e:
         logging.error(f"Error in reset_and_start_new_session: {str(e)}")
-        await update.message.reply_text(_("Oops! An error occurred. Please try again."))
+        await reply(update, context, _("Oops! An error occurred. Please try again."))
     # Display keyboard for section choice as originally implemented
-    keyboard = [[KeyboardButton(button_labels[section])] for section in Section]
-    # # Create a keyboard with two columns: one for Junior sections and another for Middle sections
-    # keyboard = [
-    #         KeyboardButton(button_labels[Section.ITJ]), 
-    #         KeyboardButton(button_labels[Section.ITM]),
-    #         KeyboardButton(button_labels[Section.QAJ]), 
-    #         KeyboardButton(button_labels[Section.QAM])
-    # ]
-    
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-    await update.message.reply_text(
+    await reply(update, context,
         _("👋 Select a section to start practicing:\n\n"
         "- <b>IT. Junior +</b>: Essential IT knowledge.\n"
         "- <b>IT. Middle +</b>: Advanced IT knowledge.\n"
@@ -208,26 +1488,21 @@ async def reset_and_start_new_session(conn, chat_id, update, context: ContextTyp
         "- <b>QA/QC. Middle +</b>:  In-depth expertise in Quality Assurance and Quality Control."),
         # "\nYou can use Skip Question button if the task doesn't correspond to your CV",
         parse_mode='HTML',
-        reply_markup=reply_markup
+        reply_markup=SECTION_KEYBOARD
     )
+@instrumented
 async def set_language_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     logging.debug(f"set_language_command called with chat_id={chat_id}")
 
-    # Retrieve user's current language preference from the database
-    async with postgres_pool.acquire() as conn:
-        user_language = await conn.fetchval("""
-            SELECT language FROM users WHERE chat_id = $1
-        """, chat_id)
-        if not user_language:
-            user_language = 'en'  # Default to English
-        context.user_data['language_code'] = user_language
+    # Retrieve user's current language preference from the session
+    session = await get_session(chat_id)
 
-        # Check if the user has an active quiz session
-        active_section = await check_active_quiz(conn, chat_id)
+    # Check if the user has an active quiz session
+    active_section = await check_active_quiz(chat_id)
 
     # Get the per-user translation function
-    _ = get_translation_function(user_language)
+    _ = get_translation_function(session.language)
 
     if active_section:
         section = active_section['section']
@@ -235,81 +1510,59 @@ async def set_language_command(update: Update, context: ContextTypes.DEFAULT_TYP
         logging.debug(f"User {chat_id} is in the middle of a quiz (section: {section}, index: {index})")
 
         # Inform the user that their progress will be saved
-        await update.message.reply_text(
+        await reply(update, context,
             _("I will save your progress, and you can continue after setting your language preference.")
         )
 
-    # Define the keyboard layout with language options
-    keyboard = [
-        [KeyboardButton("English")],
-        [KeyboardButton("Русский")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
-    
     # Send a message asking the user to choose their language
-    await update.message.reply_text(_("Select your language / Выберите язык:"), reply_markup=reply_markup)
+    await reply(update, context, _("Select your language / Выберите язык:"), reply_markup=LANGUAGE_KEYBOARD)
     
-    # Store the active quiz session in context to resume later
-    context.user_data['active_section'] = active_section
+    # Store the active quiz session to resume later
+    await save_active_section(chat_id, active_section)
 
+@instrumented
 async def section_command(update: Update, context: ContextTypes.DEFAULT_TYPE, section_str: str):
     chat_id = update.message.chat_id
-    logging.debug(f"Starting section_command with chat_id={chat_id} and section={section_str}")
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+    bind_log_context(section=section_str)
+    quiz_log.debug("Starting section_command with chat_id=%s and section=%s", chat_id, section_str)
+    # Retrieve language code from the session
+    session = await get_session(chat_id)
+    language_code = session.language
 
     _ = get_translation_function(language_code)
     # Reset the current index to 0 when a section is chosen and update the database
-    # Get a connection from the pool
-    async with postgres_pool.acquire() as conn:
-        try:
-            async with conn.transaction():
-                await conn.execute("""
-                    INSERT INTO user_progress (user_id, section, current_index)
-                    VALUES ((SELECT user_id FROM users WHERE chat_id = $1), $2, 0)
-                    ON CONFLICT (user_id, section) DO UPDATE SET current_index = 0
-                """, chat_id, section_str)
-                # Fetch questions based on the section and language
-                questions = await fetch_questions(conn, section_str, language_code)
-        except Exception as e:
-            logging.error(f"Error in section_command for chat_id={chat_id}, section={section_str}: {str(e)}")
-            await update.message.reply_text(_("Something went wrong. Let's try that again."))
+    questions = None
+    try:
+        await progress_writer.flush_user(session.user_id)
+        async with db_connection() as conn, conn.transaction():
+            progress = await conn.fetchrow(QUERIES['start_section'], chat_id, section_str)
+            # Fetch questions based on the section and language
+            questions = await get_questions(conn, section_str, language_code)
+        session.user_id = progress['user_id']
+        session.set_progress(section_str, progress)
+    except Exception as e:
+        drop_session(chat_id)
+        logging.error(f"Error in section_command for chat_id={chat_id}, section={section_str}: {str(e)}")
+        await reply(update, context, _("Something went wrong. Let's try that again."))
     if questions:
         await send_question(update, context, chat_id, questions, section_str)
     else:
         logging.error(f"No questions found for section: {section_str}")
-        await update.message.reply_text(_("This section isn't available right now. Please select a different one."))
+        await reply(update, context, _("This section isn't available right now. Please select a different one."))
 
+@instrumented
 async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     logging.debug(f"subscribe_command called with chat_id={chat_id}")
 
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+    # Retrieve language code from the session
+    session = await get_session(chat_id)
+    language_code = session.language
 
     _ = get_translation_function(language_code)
 
-    async with postgres_pool.acquire() as conn:
-        # Use the check_active_quiz function to determine if a quiz is in progress
-        active_section = await check_active_quiz(conn, chat_id)
+    # Use the check_active_quiz function to determine if a quiz is in progress
+    active_section = await check_active_quiz(chat_id)
 
     if active_section:
         section = active_section['section']
@@ -317,39 +1570,31 @@ async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.debug(f"User {chat_id} is in the middle of a quiz (section: {section}, index: {index})")
 
         # Inform the user that their progress will be saved
-        await update.message.reply_text(
+        await reply(update, context,
             _("I will save your progress, and you can continue after subscribing.")
         )
     # Proceed with asking for the email
-    await update.message.reply_text(
+    await reply(update, context,
         _("You are going to subscribe to the exclusive content via emails, including updates about future bots. "
         "Please enter your email to subscribe, or type 'Skip' to cancel.")
     )
-    waiting_for_email[chat_id] = True  # Mark that we're waiting for the email
-    # Store the active quiz session in context
-    context.user_data['active_section'] = active_section
+    await state_store.set(chat_id, 'waiting_for_email', True)  # Mark that we're waiting for the email
+    # Store the active quiz session to resume later
+    await save_active_section(chat_id, active_section)
 
+@instrumented
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     logging.debug(f"info_command called with chat_id={chat_id}")
 
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+    # Retrieve language code from the session
+    session = await get_session(chat_id)
+    language_code = session.language
 
     _ = get_translation_function(language_code)
 
-    async with postgres_pool.acquire() as conn:
-        # Use the check_active_quiz function to determine if a quiz is in progress
-        active_section = await check_active_quiz(conn, chat_id)
+    # Use the check_active_quiz function to determine if a quiz is in progress
+    active_section = await check_active_quiz(chat_id)
 
     if active_section:
         section = active_section['section']
@@ -357,7 +1602,7 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.debug(f"User {chat_id} is in the middle of a quiz (section: {section}, index: {index})")
 
         # Inform the user that their progress will be saved
-        await update.message.reply_text(
+        await reply(update, context,
             _("I will save your progress, and you can continue after viewing the info.")
         )
     
@@ -371,62 +1616,216 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Feel free to explore the resources and enhance your knowledge!"
     )
 
-    await update.message.reply_text(info_message, parse_mode='Markdown', reply_markup=ReplyKeyboardRemove())
+    await reply(update, context, info_message, parse_mode='Markdown', reply_markup=ReplyKeyboardRemove())
 
-    # Store the active quiz session in context to resume later
-    context.user_data['active_section'] = active_section
+    # Store the active quiz session to resume later
+    await save_active_section(chat_id, active_section)
     await resume_quiz_if_applicable(update, context, chat_id)
 
-async def send_question(update, context, chat_id, questions, section_str: str):
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+@instrumented
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    logging.debug(f"reload_command called with chat_id={chat_id}")
+    if chat_id not in ADMIN_CHAT_IDS:
+        logging.warning(f"Ignoring /reload from non-admin chat_id={chat_id}")
+        return
 
-    _ = get_translation_function(language_code)
-    # Fetch current index from the database
-    # Get a connection from the pool
+    # Reload the translation catalogs, drop the question cache and load every section again right away
+    load_translations()
+    invalidate_question_cache()
     try:
-        async with postgres_pool.acquire() as conn:
-            index = await conn.fetchval("SELECT current_index FROM user_progress WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1) AND section = $2", chat_id, section_str)
-            index = index or 0  # Default to 0 if no record found
+        async with db_connection() as conn:
+            counts = []
+            for section in Section:
+                for language_code in ('en', 'ru'):
+                    questions = await get_questions(conn, section.value, language_code)
+                counts.append(f"{section.value}: {len(questions)}")
     except Exception as e:
-        logging.error(f"Error in send_question: {str(e)}")
-        await update.message.reply_text(_("An error occurred. We're on it—please try again soon."))
+        logging.error(f"Error in reload_command: {str(e)}")
+        await reply(update, context, "Failed to reload the question bank.")
+        return
+    await reply(update, context, "Translations and question bank reloaded.\n" + "\n".join(counts))
 
-    question_data = questions[index]
-    logging.debug(f"Sending question with chat_id={chat_id} and section={section_str} and question index={index}")
-    # Создаем список кнопок для вариантов ответов
-    keyboard = []
+# Broadcasts
+# Not split between the workers: the advisory lock lets only one worker send a broadcast
+broadcast_bucket = TokenBucket(BROADCAST_RATE, 1)
 
-    # Получаем текст для кнопок из данных вопроса
-    answers = question_data['answers']
+class BroadcastJob:
+    """
+    Sends a broadcast to the subscribed users. Recipients are read in user_id order one batch at a time on a
+    dedicated connection (so the job does not hold a pool slot), each batch in its own short read committed
+    query so no snapshot stays open while the messages go out, and sent to in concurrent batches
+    through broadcast_bucket and the outbound dispatcher, and after every batch the delivery statuses are
+    written in bulk together with the checkpoint, so a restarted job continues after the last recipient.
+    An advisory lock on the dedicated connection keeps two workers from running the same broadcast.
+    """
+    RECIPIENTS = """
+        SELECT u.user_id, u.chat_id
+        FROM users u
+        JOIN user_details d ON d.user_id = u.user_id
+        WHERE d.subscribed AND u.user_id > $2
+          AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries b WHERE b.broadcast_id = $1 AND b.user_id = u.user_id)
+        ORDER BY u.user_id
+        LIMIT $3
+    """
 
-    # Разбиваем кнопки на две колонки
-    col1 = [KeyboardButton(answers[0]['answer_text']), KeyboardButton(answers[2]['answer_text'])]  # Первая колонка
-    col2 = [KeyboardButton(answers[1]['answer_text']), KeyboardButton(_("Skip question"))]  # Вторая колонка
+    def __init__(self, bot, broadcast_id):
+        self.bot = bot
+        self.broadcast_id = broadcast_id
 
-    # Составляем клавиатуру из двух колонок
-    for i in range(len(col1)):
-        row = [col1[i], col2[i]]  # В одной строке две кнопки: из первой и второй колонок
-        keyboard.append(row)
+    async def run(self):
+        conn = await connect_database()
+        try:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('broadcast'), $1)", self.broadcast_id):
+                logging.info(f"Broadcast {self.broadcast_id} is being sent by another worker")
+                return
+            broadcast = await conn.fetchrow(
+                "SELECT text, created_by, status, last_user_id FROM broadcasts WHERE id = $1", self.broadcast_id)
+            if broadcast is None or broadcast['status'] != 'running':
+                return
+            last_user_id = broadcast['last_user_id']
+            logging.info(f"Sending broadcast {self.broadcast_id} after user_id={last_user_id}")
+            while True:
+                batch = await conn.fetch(self.RECIPIENTS, self.broadcast_id, last_user_id, BROADCAST_BATCH_SIZE)
+                if not batch:
+                    break
+                status = await self.send_batch(batch, broadcast['text'])
+                if status != 'running':
+                    logging.info(f"Broadcast {self.broadcast_id} was {status}, stopping")
+                    return
+                last_user_id = batch[-1]['user_id']
+            totals = await self.finish()
+        finally:
+            await conn.close()
+        logging.info(f"Broadcast {self.broadcast_id} finished: {totals['sent']} sent, {totals['failed']} failed")
+        if broadcast['created_by']:
+            await send_message(self.bot, broadcast['created_by'],
+                f"Broadcast #{self.broadcast_id} finished: {totals['sent']} sent, {totals['failed']} not delivered.")
+
+    async def send_batch(self, batch, text):
+        """Send to a batch of recipients, then record the deliveries and the checkpoint. Returns the broadcast status."""
+        deliveries = []
+
+        async def send_one(user_id, chat_id):
+            await broadcast_bucket.acquire()
+            try:
+                await dispatcher.send(chat_id, self.bot.send_message, chat_id=chat_id, text=text)
+                deliveries.append((user_id, 'sent', None))
+            except Forbidden as e:
+                deliveries.append((user_id, 'blocked', str(e)))
+            except TelegramError as e:
+                deliveries.append((user_id, 'failed', str(e)))
 
-    # Создаем разметку клавиатуры
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+        try:
+            await asyncio.gather(*(send_one(row['user_id'], row['chat_id']) for row in batch))
+        except asyncio.CancelledError:
+            # Shutting down: record what was sent so it is not sent again, but keep the checkpoint
+            await asyncio.shield(self.record(deliveries, None))
+            raise
+        return await self.record(deliveries, batch[-1]['user_id'])
+
+    async def record(self, deliveries, last_user_id):
+        sent = sum(1 for _, status, _ in deliveries if status == 'sent')
+        for _, status, _ in deliveries:
+            BROADCAST_MESSAGES.inc(status=status)
+        async with db_connection() as conn, conn.transaction():
+            await conn.execute("""
+                INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, error)
+                SELECT $1, d.user_id, d.status, d.error
+                FROM unnest($2::int[], $3::text[], $4::text[]) AS d(user_id, status, error)
+                ON CONFLICT DO NOTHING
+            """, self.broadcast_id, [d[0] for d in deliveries], [d[1] for d in deliveries], [d[2] for d in deliveries])
+            return await conn.fetchval("""
+                UPDATE broadcasts
+                SET last_user_id = coalesce($2, last_user_id), sent = sent + $3, failed = failed + $4
+                WHERE id = $1
+                RETURNING status
+            """, self.broadcast_id, last_user_id, sent, len(deliveries) - sent)
+
+    async def finish(self):
+        async with db_connection() as conn:
+            return await conn.fetchrow("""
+                UPDATE broadcasts SET status = 'done', finished_at = NOW()
+                WHERE id = $1 AND status = 'running'
+                RETURNING sent, failed
+            """, self.broadcast_id) or {'sent': 0, 'failed': 0}
+
+def start_broadcast(bot, broadcast_id):
+    return run_in_background(BroadcastJob(bot, broadcast_id).run(), name=f"broadcast-{broadcast_id}")
+
+async def resume_broadcasts(bot):
+    # Continue the broadcasts that were interrupted by a restart
+    async with db_connection() as conn:
+        rows = await conn.fetch("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+    for row in rows:
+        start_broadcast(bot, row['id'])
+
+@instrumented
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    logging.debug(f"broadcast_command called with chat_id={chat_id}")
+    if chat_id not in ADMIN_CHAT_IDS:
+        logging.warning(f"Ignoring /broadcast from non-admin chat_id={chat_id}")
+        return
+
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2:
+        # Without a text, show the latest broadcasts
+        async with db_connection() as conn:
+            rows = await conn.fetch("SELECT id, status, sent, failed, created_at FROM broadcasts ORDER BY id DESC LIMIT 5")
+        lines = [f"#{row['id']} {row['status']}: {row['sent']} sent, {row['failed']} failed ({row['created_at']:%Y-%m-%d %H:%M})"
+                 for row in rows]
+        await reply(update, context, "\n".join(["Usage: /broadcast <text>, /cancel_broadcast <id>"] + lines))
+        return
+
+    async with db_connection() as conn:
+        broadcast_id = await conn.fetchval(
+            "INSERT INTO broadcasts (text, created_by) VALUES ($1, $2) RETURNING id", parts[1], chat_id)
+        recipients = await conn.fetchval("SELECT count(*) FROM user_details WHERE subscribed")
+    start_broadcast(context.bot, broadcast_id)
+    await reply(update, context, f"Broadcast #{broadcast_id} started for {recipients} subscribed users.")
+
+@instrumented
+async def cancel_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    if chat_id not in ADMIN_CHAT_IDS:
+        logging.warning(f"Ignoring /cancel_broadcast from non-admin chat_id={chat_id}")
+        return
+    if len(context.args) != 1 or not context.args[0].lstrip('#').isdigit():
+        await reply(update, context, "Usage: /cancel_broadcast <id>")
+        return
+    broadcast_id = int(context.args[0].lstrip('#'))
+    # The job stops after its current batch
+    async with db_connection() as conn:
+        result = await conn.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = NOW() WHERE id = $1 AND status = 'running'",
+            broadcast_id)
+    cancelled = result.split()[-1] != '0'
+    await reply(update, context, f"Broadcast #{broadcast_id} cancelled." if cancelled else f"Broadcast #{broadcast_id} is not running.")
+
+@instrumented
+async def send_question(update, context, chat_id, questions, section_str: str):
+    session = await get_session(chat_id)
+    # Current index comes from the session
+    index = session.index if session.section == section_str else None
+    index = index or 0  # Default to 0 if no progress recorded
+
+    question_data = questions[index]
+    quiz_log.debug("Sending question with chat_id=%s and section=%s and question index=%s", chat_id, section_str, index)
+    # The keyboard and the texts were built when the question bank was loaded
+    if QUIZ_MODE == 'inline':
+        # One message, edited in place by handle_answer_callback as the user answers
+        await send_message(context.bot, chat_id, question_data['text_with_separator'], parse_mode='HTML',
+                           reply_markup=question_data['inline_markup'])
+        return
+    reply_markup = question_data['reply_markup']
+    if COALESCE_QUESTION_SEPARATOR:
+        # One message instead of two
+        await send_message(context.bot, chat_id, question_data['text_with_separator'], parse_mode='HTML', reply_markup=reply_markup)
+        return
 
     # Send the separator
-    await context.bot.send_message(
-         chat_id=chat_id,
-         text=f"<b>• • • 📚 📚 📚 • • • </b>",
-         parse_mode='HTML',
-    )
+    await send_message(context.bot, chat_id, QUESTION_SEPARATOR, parse_mode='HTML')
     # await asyncio.sleep(1)
 
     # # Удаляем сообщение
@@ -434,390 +1833,805 @@ async def send_question(update, context, chat_id, questions, section_str: str):
     #     chat_id=chat_id,
     #     message_id=sent_message.message_id
     # )
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"🧩 {question_data['question_text']}",
-        parse_mode='HTML',
-        reply_markup=reply_markup
+    await send_message(context.bot, chat_id, question_data['text'], parse_mode='HTML', reply_markup=reply_markup)
+
+async def record_answer(conn, session, section_str, question_count, outcome):
+    """
+    Record an answer and move to the next question in a single atomic statement.
+    The update only applies if the progress is still at the question the session is showing,
+    so a repeated or concurrent tap on the same question is not counted twice.
+    When the last question is answered the progress is reset, and the returned counters
+    are the final results of the section.
+    :param conn: The database connection object.
+    :param session: The Session of the user, updated with the new progress.
+    :param section_str: The section the answer belongs to.
+    :param question_count: The number of questions in the section.
+    :param outcome: 'correct', 'incorrect', 'skipped' or None for an unrecognized answer.
+    :return: A record with current_index (None when the section is completed) and the counters, or None if nothing was updated.
+    """
+    progress = await conn.fetchrow(
+        QUERIES['record_answer'], session.user_id, section_str, session.index,
+        int(outcome == 'correct'), int(outcome == 'incorrect'), int(outcome == 'skipped'), question_count)
+    if progress is None:
+        return None
+    if progress['current_index'] is None:
+        # The section is completed and its counters were reset
+        session.index = None
+        session.correct = session.incorrect = session.skipped = 0
+    else:
+        session.set_progress(section_str, progress)
+    return progress
+
+RESULTS_SEPARATOR = "<b>• • • ✔️ ✔️ ✔️ • • • </b>"
+
+async def save_answer(session, section_str, question_count, outcome):
+    # record_answer, or its write-behind counterpart
+    if progress_writer.enabled:
+        return progress_writer.record_answer(session, section_str, question_count, outcome)
+    async with db_connection() as conn:
+        return await record_answer(conn, session, section_str, question_count, outcome)
+
+def format_results(_, section_str, progress):
+    # Get the button label for the section
+    button_label = label_to_section.get(section_str, section_str)
+    return _(
+        "Good job! You've completed all the questions in the {section} section with the following results:\n"
+        "Correct: {correct}\n"
+        "Incorrect: {incorrect}\n"
+        "Skipped: {skipped}"
+    ).format(
+    section=button_label,
+    correct=progress['correct_answers'],
+    incorrect=progress['incorrect_answers'],
+    skipped=progress['skipped_questions']
     )
 
+async def resend_current_question(update, context, chat_id, questions, section_str):
+    """
+    The answer was not recorded because the progress changed meanwhile (another update, an import),
+    so show the question the user is actually at. Called after drop_session, so the progress is read again.
+    """
+    session = await get_session(chat_id)
+    if session.section == section_str and session.index is not None and session.index < len(questions):
+        await send_question(update, context, chat_id, questions, section_str)
+    else:
+        _ = get_translation_function(session.language)
+        await send_message(context.bot, chat_id, _("It looks like you don't have any active quizzes."),
+                           reply_markup=SECTION_KEYBOARD_RESIZED)
+
+@instrumented
 async def handle_quiz(update, context, questions, section_str: str):
     chat_id = update.message.chat_id
     text = update.message.text
-    logging.debug(f"handle_quiz called with chat_id={chat_id}, text={text}, section={section_str}")
-
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+    bind_log_context(section=section_str)
+    quiz_log.debug("handle_quiz called with chat_id=%s, text=%s, section=%s", chat_id, text, section_str)
+
+    # Retrieve language code from the session
+    session = await get_session(chat_id)
+    language_code = session.language
 
     _ = get_translation_function(language_code)
 
-    # Fetch question data and index from database
-    async with postgres_pool.acquire() as conn:
-        try:
-            index = await conn.fetchval("""
-                SELECT current_index FROM user_progress 
-                WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1) 
-                AND section = $2
-            """, chat_id, section_str)
-            if index is not None:
-                question_data = questions[index]
-                logging.info(f"Retrieved question index {index} for chat_id={chat_id}, section={section_str}")
-                # Determine if the provided answer is correct
-                selected_answer = None                
-                if text == _("Skip question"):
-                    # Increment skipped counter
-                    await conn.execute("""
-                        UPDATE user_progress 
-                        SET skipped_questions = skipped_questions + 1 
-                        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1) AND section = $2
-                    """, chat_id, section_str)
-                    new_index = index + 1 if (index + 1 < len(questions)) else 0  # Move to next question, wrap around if at the end
-                    # Update the user's progress
-                    await conn.execute("""
-                        UPDATE user_progress 
-                        SET current_index = $1 
-                        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $2) AND section = $3
-                    """, new_index, chat_id, section_str)
-                elif text == _("No, continue my current session"):
-                    # Just re-send the current question, do not increment the index
-                    await send_question(update, context, chat_id, questions, section_str)
-                    return
-                else:
-                    selected_answer = next((answer for answer in question_data['answers'] if answer['answer_text'] == text), None)
-                    if selected_answer:
-                        if selected_answer['is_correct']:
-                            # await context.bot.send_message(
-                            #     chat_id=chat_id,
-                            #     text="🌟\n",  # Анимация конфетти для празднования правильного ответа
-                            # )
-                            sent_message=await context.bot.send_message(
-                                chat_id=chat_id,
-                                text="🌟\n"
-                            )
-                            await asyncio.sleep(0.5)
-
-                            # Удаляем сообщение
-                            await context.bot.delete_message(
-                                 chat_id=chat_id,
-                                 message_id=sent_message.message_id
-                            )
-                            response = _("🌟 Correct!\n\n{explanation}").format(explanation=selected_answer['explanation'])
-                        else:
-                            sent_message=await context.bot.send_message(
-                                chat_id=chat_id,
-                                text="❗️\n"
-                            )
-                            await asyncio.sleep(0.5)
-
-                            # Удаляем сообщение
-                            await context.bot.delete_message(
-                                 chat_id=chat_id,
-                                 message_id=sent_message.message_id
-                            )
-                            response = _("❗️ That's not the right answer.\n\n{explanation}").format(explanation=selected_answer['explanation'])
-                        await update.message.reply_text(response)
-                        # Increment correct or incorrect counter
-                        field = 'correct_answers' if selected_answer['is_correct'] else 'incorrect_answers'
-                        await conn.execute(f"""
-                            UPDATE user_progress 
-                            SET {field} = {field} + 1 
-                            WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1) AND section = $2
-                        """, chat_id, section_str)
-                    # Calculate the new index
-                    new_index = index + 1 if (index + 1 < len(questions)) else 0
-                    # Update the user's progress
-                    logging.info(f"Updating user_progress with new_index={new_index} for chat_id={chat_id}, section={section_str}")
-                    await conn.execute("""
-                        UPDATE user_progress 
-                        SET current_index = $1 
-                        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $2) AND section = $3
-                    """, new_index, chat_id, section_str)
-                # Update the user progress
-                # logging.info(f"Updating user_progress with new_index={new_index} for chat_id={chat_id}, section={section_str}")
-                # await conn.execute("""
-                #     INSERT INTO user_progress (user_id, section, current_index)
-                #     VALUES ((SELECT user_id FROM users WHERE chat_id = $1), $2, $3)
-                #     ON CONFLICT (user_id, section) DO UPDATE SET current_index = EXCLUDED.current_index
-                #  """, chat_id, section_str, new_index)
-
-                if new_index > 0:
-                    await send_question(update, context, chat_id, questions, section_str)
-                else:
-                    logging.info(f"Printing statistics of answers for chat_id={chat_id}, section={section_str}")
-                    stats = await conn.fetchrow("""
-                        SELECT correct_answers, incorrect_answers, skipped_questions 
-                        FROM user_progress 
-                        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1) AND section = $2
-                    """, chat_id, section_str)
-                    # Get the button label for the section
-                    button_label = label_to_section.get(section_str, section_str)
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=f"<b>• • • ✔️ ✔️ ✔️ • • • </b>",
-                        parse_mode='HTML',
-                    )
-                    stats_message = _(
-                        "Good job! You've completed all the questions in the {section} section with the following results:\n"
-                        "Correct: {correct}\n"
-                        "Incorrect: {incorrect}\n"
-                        "Skipped: {skipped}"
-                    ).format(
-                    section=button_label,
-                    correct=stats['correct_answers'],
-                    incorrect=stats['incorrect_answers'],
-                    skipped=stats['skipped_questions']
-                    )
-
-                    await update.message.reply_text(stats_message)
-
-                    logging.info(f"Resetting user_progress with new_index=NULL for chat_id={chat_id}, section={section_str}")
-                    await conn.execute("""
-                        UPDATE user_progress 
-                        SET correct_answers = 0, incorrect_answers = 0, skipped_questions = 0, current_index = NULL
-                        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1) AND section = $2
-                    """, chat_id, section_str)  # Note the parameters are not in a single tuple here.
-
-                    # Send completion message with keyboard for choosing another section
-                    keyboard = [[KeyboardButton(button_labels[s])] for s in Section]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-                    completion_message = _("Ready for more? Choose another section to keep practicing, or redo this one for perfection!")
-                    await update.message.reply_text(completion_message, reply_markup=reply_markup)
-            else:
-                logging.warning(f"No progress found for chat_id={chat_id}, section={section_str}")
-                await update.message.reply_text(_("It looks like you don't have any active quizzes."))
-        except Exception as e:
-            logging.error(f"Database error in handle_quiz for chat_id={chat_id}: {e}")
-            await update.message.reply_text(_("A database error occurred. Please try again later."))
+    # Question index comes from the session, writes go to the database first and then to the session
+    index = session.index if session.section == section_str else None
+    if index is None:
+        quiz_log.warning("No progress found for chat_id=%s, section=%s", chat_id, section_str)
+        await reply(update, context, _("It looks like you don't have any active quizzes."))
+        return
 
+    question_data = questions[index]
+    quiz_log.debug("Retrieved question index %s for chat_id=%s, section=%s", index, chat_id, section_str)
+    # Determine if the provided answer is correct
+    selected_answer = None
+    action, _value = get_reply_action(language_code, text)
+    if action == 'resend' or QUIZ_MODE == 'inline':
+        # Just re-send the current question, do not increment the index (inline answers come as callbacks)
+        await send_question(update, context, chat_id, questions, section_str)
+        return
+    elif action == 'skip':
+        outcome = 'skipped'
+    else:
+        selected_answer = question_data['answers_by_text'].get(normalize_answer_text(text))
+        if selected_answer:
+            outcome = 'correct' if selected_answer['is_correct'] else 'incorrect'
+        else:
+            outcome = None  # Unrecognized text still moves on to the next question
+
+    # Update the counters and the user's progress in one statement.
+    # The connection goes back to the pool before any Telegram I/O happens.
+    try:
+        progress = await save_answer(session, section_str, len(questions), outcome)
+    except Exception as e:
+        # The session may be out of date now, load it again on next use
+        drop_session(chat_id)
+        quiz_log.error("Database error in handle_quiz for chat_id=%s: %s", chat_id, e)
+        await reply(update, context, _("A database error occurred. Please try again later."))
+        return
+    if progress is None:
+        quiz_log.info("Progress for chat_id=%s, section=%s is no longer at index %s, ignoring the answer", chat_id, section_str, index)
+        drop_session(chat_id)
+        await resend_current_question(update, context, chat_id, questions, section_str)
+        return
+    new_index = progress['current_index']
+    quiz_log.debug("Updated user_progress with new_index=%s for chat_id=%s, section=%s", new_index, chat_id, section_str)
+
+    if selected_answer:
+        # Flash 🌟/❗️ for a moment without holding up the explanation and the next question
+        if selected_answer['is_correct']:
+            flash_message(context.bot, chat_id, "🌟\n")
+            response = _("🌟 Correct!\n\n{explanation}").format(explanation=selected_answer['explanation'])
+        else:
+            flash_message(context.bot, chat_id, "❗️\n")
+            response = _("❗️ That's not the right answer.\n\n{explanation}").format(explanation=selected_answer['explanation'])
+        await reply(update, context, response)
+
+    if new_index is not None:
+        await send_question(update, context, chat_id, questions, section_str)
+    else:
+        quiz_log.info("Printing statistics of answers for chat_id=%s, section=%s", chat_id, section_str)
+        await send_message(context.bot, chat_id, RESULTS_SEPARATOR, parse_mode='HTML')
+        await reply(update, context, format_results(_, section_str, progress))
+
+        # Send completion message with keyboard for choosing another section
+        completion_message = _("Ready for more? Choose another section to keep practicing, or redo this one for perfection!")
+        await reply(update, context, completion_message, reply_markup=SECTION_KEYBOARD_RESIZED)
+
+@instrumented
+async def handle_answer_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    An inline answer or skip button was tapped (QUIZ_MODE=inline). The answer is recorded like in handle_quiz,
+    and the question message is edited to show the feedback and the next question (or the results).
+    """
+    query = update.callback_query
+    parsed = parse_answer_callback(query.data)
+    if query.message is None or parsed is None:
+        # The message is too old to be edited (or inaccessible), or the data is not ours
+        quiz_log.debug("Ignoring callback query %s with data=%s", query.id, query.data)
+        _ = get_translation_function(query.from_user.language_code if query.from_user else None)
+        await answer_callback(query, _("This question is no longer active."))
+        return
+    kind, question_id, answer_id = parsed
+    chat_id = query.message.chat_id
+    quiz_log.debug("handle_answer_callback called with chat_id=%s, data=%s", chat_id, query.data)
+
+    session = await get_session(chat_id)
+    _ = get_translation_function(session.language)
+    section_str, index = session.section, session.index
+    bind_log_context(section=section_str)
+    questions = await get_questions(None, section_str, session.language) if section_str and index is not None else None
+    # Only the buttons of the current question count, older messages may still show buttons
+    if not questions or index >= len(questions) or questions[index]['question_id'] != question_id:
+        await answer_callback(query, _("This question is no longer active."))
+        return
+    question_data = questions[index]
+    selected_answer = None
+    if kind == 's':
+        outcome = 'skipped'
+    else:
+        selected_answer = question_data['answers_by_id'].get(answer_id)
+        if selected_answer is None:
+            await answer_callback(query, _("This question is no longer active."))
+            return
+        outcome = 'correct' if selected_answer['is_correct'] else 'incorrect'
+
+    try:
+        progress = await save_answer(session, section_str, len(questions), outcome)
+    except Exception as e:
+        drop_session(chat_id)
+        quiz_log.error("Database error in handle_answer_callback for chat_id=%s: %s", chat_id, e)
+        await answer_callback(query, _("A database error occurred. Please try again later."))
+        return
+    if progress is None:
+        drop_session(chat_id)
+        await answer_callback(query, _("This question is no longer active."))
+        await resend_current_question(update, context, chat_id, questions, section_str)
+        return
+
+    parts = []
+    if selected_answer:
+        if selected_answer['is_correct']:
+            await answer_callback(query, "🌟")
+            feedback = _("🌟 Correct!\n\n{explanation}")
+        else:
+            await answer_callback(query, "❗️")
+            feedback = _("❗️ That's not the right answer.\n\n{explanation}")
+        # The message is HTML because of the separators
+        parts.append(html.escape(feedback.format(explanation=selected_answer['explanation'] or '')))
+    else:
+        await answer_callback(query)
+
+    if progress['current_index'] is not None:
+        next_question = questions[progress['current_index']]
+        parts.append(next_question['text_with_separator'])
+        await edit_message(context.bot, chat_id, query.message.message_id, '\n\n'.join(parts), parse_mode='HTML',
+                           reply_markup=next_question['inline_markup'])
+    else:
+        parts.append(RESULTS_SEPARATOR)
+        parts.append(html.escape(format_results(_, section_str, progress)))
+        await edit_message(context.bot, chat_id, query.message.message_id, '\n\n'.join(parts), parse_mode='HTML')
+        completion_message = _("Ready for more? Choose another section to keep practicing, or redo this one for perfection!")
+        await send_message(context.bot, chat_id, completion_message, reply_markup=SECTION_KEYBOARD_RESIZED)
+
+@instrumented
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     text = update.message.text
-    logging.debug(f"Received message: {text} from chat_id: {chat_id}")
-
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+    message_log.debug("Received message: %s from chat_id: %s", text, chat_id)
+
+    # Retrieve language code from the session
+    session = await get_session(chat_id)
+    language_code = session.language
 
     _ = get_translation_function(language_code)
 
-    if chat_id in waiting_for_email and waiting_for_email[chat_id]:
+    if await state_store.get(chat_id, 'waiting_for_email'):
         # Handle email or skipping logic
         if text.lower() == "skip":
-            logging.debug(f"User {chat_id} chose to skip subscribing.")
-            waiting_for_email[chat_id] = False
-            await update.message.reply_text(
+            message_log.debug("User %s chose to skip subscribing.", chat_id)
+            await state_store.delete(chat_id, 'waiting_for_email')
+            await reply(update, context,
                 _("No problem! You can subscribe anytime by using the /subscribe command."),
                 reply_markup=ReplyKeyboardRemove()
             )
             await resume_quiz_if_applicable(update, context, chat_id)
         elif "@" in text and "." in text:
-            async with postgres_pool.acquire() as conn:
-                user_id = await conn.fetchval("""
-                    SELECT user_id FROM users WHERE chat_id = $1
-                """, chat_id)
+            async with db_connection() as conn:
                 await conn.execute("""
                     INSERT INTO user_details (user_id, email, subscribed) VALUES ($1, $2, TRUE)
                     ON CONFLICT (user_id) DO UPDATE SET email = EXCLUDED.email, subscribed = TRUE
-                """, user_id, text)
-            logging.debug(f"Email {text} stored for user {chat_id} with subscription.")
-            waiting_for_email[chat_id] = False
-            await update.message.reply_text(
+                """, session.user_id, text)
+            message_log.debug("Email %s stored for user %s with subscription.", text, chat_id)
+            await state_store.delete(chat_id, 'waiting_for_email')
+            await reply(update, context,
                 _("Thank you for subscribing!"),
                 reply_markup=ReplyKeyboardRemove()
             )
             await resume_quiz_if_applicable(update, context, chat_id)
         else:
-            logging.debug(f"User {chat_id} provided an invalid email: {text}")
-            await update.message.reply_text(
+            message_log.debug("User %s provided an invalid email: %s", chat_id, text)
+            await reply(update, context,
                 _("That doesn't seem like a valid email. Please enter a valid email address or type 'Skip' to cancel.")
             )
         return
 
-    # Update last active date
-    async with postgres_pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE user_details 
-            SET last_active_date = NOW() 
-            WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1)
-        """, chat_id)
-
-    if text in ["English", "Русский"]:
-        language = 'ru' if text == "Русский" else 'en'
-        logging.info(f"Updating user language for chat_id={chat_id}, with language={language}")
-        async with postgres_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET language = $1 WHERE chat_id = $2", language, chat_id)
-        context.user_data['language_code'] = language
+    # Update last active date, written to the database with the next flush
+    activity.touch(session.user_id)
+
+    action, value = get_reply_action(language_code, text)
+
+    if action == 'language':
+        language = value
+        message_log.info("Updating user language for chat_id=%s, with language=%s", chat_id, language)
+        async with db_connection() as conn:
+            await conn.execute(QUERIES['set_language'], language, chat_id)
+        session.language = language
         _ = get_translation_function(language)
-        await update.message.reply_text(_("Language updated."))
+        await reply(update, context, _("Language updated."))
         await resume_quiz_if_applicable(update, context, chat_id)  # Resume quiz if there was one
         return
 
     # Handle the responses to the start command reset prompt
-    if text == _("Yes, reset progress"):
-        async with postgres_pool.acquire() as conn:
-            await reset_and_start_new_session(conn, chat_id, update, context)
+    if action == 'reset':
+        await reset_and_start_new_session(chat_id, update, context)
         return
-    elif text == _("No, continue where I left off"):
+    elif action == 'continue':
         # Handle continuation without resetting progress
-        await update.message.reply_text(_("Great, let's pick up where you left off..."))
+        await reply(update, context, _("Great, let's pick up where you left off..."))
         try:
-            async with postgres_pool.acquire() as conn:
-                active_section = await check_active_quiz(conn, chat_id)
-                if active_section:
-                    await resume_quiz_if_applicable(update, context, chat_id)
-                else:
-                    await update.message.reply_text(_("No active session found. Please start a new one."))
+            active_section = await check_active_quiz(chat_id)
+            if active_section:
+                await resume_quiz_if_applicable(update, context, chat_id)
+            else:
+                await reply(update, context, _("No active session found. Please start a new one."))
         except Exception as e:
-            logging.error(f"Error handling continuation: {e}")
-            await update.message.reply_text(_("There was an issue processing your request. Please try again later."))
+            message_log.error("Error handling continuation: %s", e)
+            await reply(update, context, _("There was an issue processing your request. Please try again later."))
         return
 
-    # Mapping the text from the keyboard to the section command
-    section_map = {label: section.value for section, label in button_labels.items()}
-    if text in section_map:
-        # Call the correct function based on the keyboard input
-        await section_command(update, context, section_map[text])
+    # Section buttons from the keyboard map to the section command
+    if action == 'section':
+        await section_command(update, context, value)
         return
     
-    # Initialize active_section outside of the connection scope
-    active_section = None
     # Handle quiz-related interactions or other messages
     try:
-        async with postgres_pool.acquire() as conn:
-            active_section = await conn.fetchrow("""
-                SELECT section, current_index FROM user_progress 
-                WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1)
-                AND current_index IS NOT NULL
-            """, chat_id)
+        active_section = await check_active_quiz(chat_id)
 
-            if active_section:
-                section, index = active_section['section'], active_section['current_index']
-                logging.debug(f"section for active_section {section} for chat_id={chat_id}, index={index}")
-                if index is not None:
-                    # TO DO Implement caching
-                    # Retrieve language_code from context.user_data
-                    language_code = context.user_data.get('language_code', 'en')
-                    # Fetch questions with the language_code
-                    questions = await fetch_questions(conn, section, language_code)
-                    if questions and index < len(questions):
-                        logging.debug(f"Active Section: {section}")
-                        await handle_quiz(update, context, questions, section)
-                    else:
-                        await update.message.reply_text(_("You've completed all questions in this section. Choose another section!"))
-                return
+        if active_section:
+            section, index = active_section['section'], active_section['current_index']
+            message_log.debug("section for active_section %s for chat_id=%s, index=%s", section, chat_id, index)
+            # Fetch questions with the language_code from the question cache
+            questions = await get_questions(None, section, language_code)
+            if questions and index < len(questions):
+                message_log.debug("Active Section: %s", section)
+                await handle_quiz(update, context, questions, section)
             else:
-                if 'hello' in text.lower():
-                    await update.message.reply_text(_("Hello! Click on /start menu ;)"))
-                elif 'help' in text.lower():
-                    await update.message.reply_text(_("If you need help, please send an email to irina.sokolova.qa@gmail.com with a detailed description of your issue. Type '/start' to work with the bot."))
-                else:
-                    await update.message.reply_text(_("I'm not sure how to respond to that. Please type '/start' or 'help'."))
+                await reply(update, context, _("You've completed all questions in this section. Choose another section!"))
+            return
+        else:
+            if 'hello' in text.lower():
+                await reply(update, context, _("Hello! Click on /start menu ;)"))
+            elif 'help' in text.lower():
+                await reply(update, context, _("If you need help, please send an email to irina.sokolova.qa@gmail.com with a detailed description of your issue. Type '/start' to work with the bot."))
+            else:
+                await reply(update, context, _("I'm not sure how to respond to that. Please type '/start' or 'help'."))
     except Exception as e:
-        logging.error(f"Error handling message: {e}")
-        await update.message.reply_text(_("There was an issue processing your request. Please try again later."))
+        message_log.error("Error handling message: %s", e)
+        await reply(update, context, _("There was an issue processing your request. Please try again later."))
 
-async def check_active_quiz(conn, chat_id):
+async def check_active_quiz(chat_id, conn=None):
     """
     Check if there is an active quiz session for the user.
-    :param conn: The database connection object.
     :param chat_id: The chat ID of the user.
+    :param conn: The database connection object to use if the session is not cached, otherwise the update's connection is used.
     :return: A dictionary with section and current_index if an active session exists, otherwise None.
     """
-    active_section = await conn.fetchrow("""
-        SELECT section, current_index FROM user_progress 
-        WHERE user_id = (SELECT user_id FROM users WHERE chat_id = $1)
-        AND current_index IS NOT NULL
-    """, chat_id)
-    return active_section
+    session = await get_session(chat_id, conn)
+    if session.section is None or session.index is None:
+        return None
+    return {'section': session.section, 'current_index': session.index}
+
+async def save_active_section(chat_id, active_section):
+    if active_section:
+        await state_store.set(chat_id, 'active_section', active_section)
+    else:
+        await state_store.delete(chat_id, 'active_section')
 
 async def resume_quiz_if_applicable(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id):
-    # Retrieve language code
-    language_code = context.user_data.get('language_code')
-    if not language_code:
-        # Fetch from the database if not in user_data
-        async with postgres_pool.acquire() as conn:
-            language_code = await conn.fetchval("""
-                SELECT language FROM users WHERE chat_id = $1
-            """, chat_id)
-            if not language_code:
-                language_code = 'en'
-            context.user_data['language_code'] = language_code
+    # Retrieve language code from the session
+    session = await get_session(chat_id)
+    language_code = session.language
 
     _ = get_translation_function(language_code)
-    # Check if there's a quiz to resume using context or directly via the function
-    active_section = context.user_data.get('active_section')
+    # Check if there's a quiz to resume using the saved state or directly via the function
+    active_section = await state_store.get(chat_id, 'active_section')
     if not active_section:
-        async with postgres_pool.acquire() as conn:
-            active_section = await check_active_quiz(conn, chat_id)
-            if not active_section:
-                # Automatically trigger the /start command
-                await start_command(update, context)
-                return
+        active_section = await check_active_quiz(chat_id)
+        if not active_section:
+            # Automatically trigger the /start command
+            await start_command(update, context)
+            return
     if active_section:
         logging.debug(f"Resuming quiz for chat_id={chat_id}, section={active_section['section']}, index={active_section['current_index']}")
         # Fetch the questions again based on the saved section
-        async with postgres_pool.acquire() as conn:
-            language_code = context.user_data.get('language_code', 'en')
-            questions = await fetch_questions(conn, active_section['section'], language_code)
-            if questions and active_section['current_index'] < len(questions):
-                await send_question(update, context, chat_id, questions, active_section['section'])
-            else:
-                await update.message.reply_text(_("We had trouble fetching the questions. Please start over."))
+        questions = await get_questions(None, active_section['section'], language_code)
+        if questions and active_section['current_index'] < len(questions):
+            await send_question(update, context, chat_id, questions, active_section['section'])
+        else:
+            await reply(update, context, _("We had trouble fetching the questions. Please start over."))
         # Clear the saved state after resumption
-        context.user_data.pop('active_section', None)
+        await state_store.delete(chat_id, 'active_section')
     else:
         logging.debug(f"No active quiz session to resume for chat_id={chat_id}.")
 
 async def error(update, context):
-    print(f'Update {update} caused error {context.error}')
-    traceback.print_exception(None, context.error, context.error.__traceback__)
+    # Runs in the update's task, so the record carries its update_id and chat_id
+    updates_log.error("Update %s caused error %s", update, context.error, exc_info=context.error)
 
-async def set_webhook(app):
-    await app.bot.set_webhook(WEBHOOK_URL)
-    print(f"Webhook set to {WEBHOOK_URL}")  # Adding a print statement to confirm the URL.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently, while the updates of one chat
+    are processed one at a time in the order they arrived. An update takes a concurrency slot
+    only once it is its chat's turn, so the updates queued behind a busy chat do not hold
+    the slots that other chats need.
+    """
+    __slots__ = ('_concurrency', '_chat_locks', '_running', 'dropping', 'processed', 'dropped')
+
+    # The semaphore of BaseUpdateProcessor.process_update is taken before the chat's turn, so it gets
+    # a limit that is never reached and the real one is applied in do_process_update
+    UNLIMITED = 1_000_000
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(self.UNLIMITED)
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self._concurrency = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_locks = {}  # chat_id -> [lock, number of updates waiting for or holding it]
+        self._running = {}  # task -> update id, for the updates started and not finished yet
+        self.dropping = False  # Set on shutdown when the drain deadline has passed
+        self.processed = 0
+        self.dropped = []  # Ids of the updates given up on shutdown
+
+    @property
+    def in_flight(self):
+        return len(self._running)
+
+    def drop_remaining(self):
+        """Cancel the updates still running or waiting and skip the ones that arrive later, the drain deadline has passed."""
+        self.dropping = True
+        for task in self._running:
+            task.cancel()
+
+    async def do_process_update(self, update, coroutine):
+        update_id = update.update_id if isinstance(update, Update) else None
+        if self.dropping:
+            coroutine.close()
+            self.dropped.append(update_id)
+            return
+        task = asyncio.current_task()
+        self._running[task] = update_id
+        try:
+            await self._process_in_order(update, coroutine)
+            self.processed += 1
+        except asyncio.CancelledError:
+            if not self.dropping:
+                raise
+            # Returning normally lets the application mark the update as done, so Application.stop() finishes
+            if hasattr(task, 'uncancel'):  # Python 3.11+
+                task.uncancel()
+            coroutine.close()
+            self.dropped.append(update_id)
+        finally:
+            del self._running[task]
+
+    async def _process_in_order(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._concurrency:
+                await self._process(update, coroutine, chat)
+            return
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # The chat's turn first, then a concurrency slot
+            async with entry[0], self._concurrency:
+                await self._process(update, coroutine, chat)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat.id]
+
+    async def _process(self, update, coroutine, chat):
+        # Called with the chat's lock and a concurrency slot held
+        if isinstance(update, Update):
+            # This runs in the update's own task, so the context stays with this update
+            log_context.set({'update_id': update.update_id, 'chat_id': chat.id if chat else None})
+        async with unit_of_work():
+            if chat is not None and state_store.shared:
+                # The retry of a slow update may have reached another worker
+                if not await state_store.claim_update(update.update_id):
+                    updates_log.info("Dropping update %s for chat_id=%s, another worker has it", update.update_id, chat.id)
+                    DUPLICATE_UPDATES.inc(layer='shared')
+                    coroutine.close()
+                    return
+                # Another worker may have changed this user's progress, so read it fresh for every update
+                drop_session(chat.id)
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def post_stop(app, deadline=None):
+    """
+    Send what is still queued and write the buffers, after the application stopped processing updates.
+    :param deadline: time.monotonic() by which the queued messages must be sent.
+    :return: About how many outbound messages were dropped.
+    """
+    await finish_background_tasks()
+    dropped_messages = await dispatcher.drain(timeout=5 if deadline is None else max(1.0, deadline - time.monotonic()))
+    try:
+        written = await progress_writer.flush()
+        if written:
+            logging.info(f"Wrote the progress of {written} users on shutdown")
+    except Exception as e:
+        logging.error(f"Error writing the progress on shutdown: {e}")
+    try:
+        await activity.flush()
+    except Exception as e:
+        logging.error(f"Error flushing the last activity on shutdown: {e}")
+    return dropped_messages
+
+async def close_pool(timeout):
+    # Wait for the connections in use to be released, then close them
+    if postgres_pool is None:
+        return
+    try:
+        await asyncio.wait_for(postgres_pool.close(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning("Connections were still in use after the shutdown deadline, terminating the pool")
+        postgres_pool.terminate()
+
+async def drain_and_stop(app, server):
+    """
+    Shut down within SHUTDOWN_TIMEOUT after SIGTERM: stop accepting updates (Telegram re-delivers the ones answered
+    with 503 to the new dyno), let the queued and running updates finish, send the queued messages, write the buffers
+    and close the pool. Updates still running at the deadline are cancelled, their transactions are rolled back.
+    """
+    global accepting_updates
+    started = time.monotonic()
+    deadline = started + SHUTDOWN_TIMEOUT
+    processor = app.update_processor
+    accepting_updates = False
+    server.stop()
+    queued = app.update_queue.qsize()
+    logging.info(f"Shutting down, {queued} updates queued and {processor.in_flight} running")
+
+    # Application.stop() returns once every update taken from the queue has been processed
+    stopping = asyncio.ensure_future(app.stop())
+    try:
+        await asyncio.wait_for(asyncio.shield(stopping), max(0.0, deadline - SHUTDOWN_FLUSH_TIME - time.monotonic()))
+    except asyncio.TimeoutError:
+        logging.warning(f"Drain deadline passed with {processor.in_flight} updates running, dropping the rest")
+        processor.drop_remaining()
+        await stopping
+    await server.close_all_connections()
+
+    # The bot is still usable here, so pending feedback and queued messages can be sent
+    dropped_messages = await post_stop(app, deadline - 2)
+    await close_pool(max(1.0, deadline - time.monotonic()))
+    dropped = processor.dropped
+    logging.info(f"Shut down in {time.monotonic() - started:.1f} s: {processor.processed} updates processed, "
+                 f"{len(dropped)} dropped{f' ({dropped})' if dropped else ''}, {dropped_messages} outbound messages dropped")
+
+# The webhook URL Telegram is known to have, so it is checked at most once per process
+registered_webhook_url = None
+
+async def set_webhook(bot):
+    # Only register the webhook when Telegram does not have this URL already
+    global registered_webhook_url
+    if registered_webhook_url != WEBHOOK_URL:
+        info = await bot.get_webhook_info()
+        if info.url != WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL)
+            logging.info(f"Webhook set to {WEBHOOK_URL}")
+        else:
+            logging.info(f"Webhook already set to {WEBHOOK_URL}")
+        registered_webhook_url = WEBHOOK_URL
+
+async def warm_question_cache():
+    # Load every section up front so the first users after a restart do not wait for it
+    started = time.monotonic()
+    for section in Section:
+        for language_code in SUPPORTED_LANGUAGES:
+            await get_questions(None, section.value, language_code)
+    logging.info(f"Question cache warmed in {(time.monotonic() - started) * 1000:.0f} ms")
+
+class StartupTimer:
+    """Measures the phases of the startup and logs them once the bot is ready."""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        yield
+        self.phases.append((name, time.monotonic() - started))
+
+    def report(self):
+        phases = ', '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases)
+        logging.info(f"Ready after {(time.monotonic() - self.started) * 1000:.0f} ms ({phases})")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves the metrics of this process in the Prometheus text format."""
+    def get(self):
+        if METRICS_TOKEN and self.request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            self.set_status(401)
+            return
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
+class UpdateWindow:
+    """
+    The most recent update ids seen by this process, to drop updates Telegram delivers again.
+    Update ids increase, so a retry arrives while its id is still among the last `size`.
+    """
+    def __init__(self, size=UPDATE_DEDUP_WINDOW):
+        self._ids = set()
+        self._order = deque()
+        self.size = size
+
+    def seen(self, update_id):
+        # True when the id was seen before, otherwise it is remembered
+        if update_id in self._ids:
+            return True
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return False
+
+update_window = UpdateWindow()
+
+# Cleared on shutdown, from then on the webhook answers 503
+accepting_updates = True
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """
+    Receives updates from Telegram and puts them on the application's update queue.
+    The webhook is answered right away, the handlers run from the queue, so Telegram has no reason
+    to re-deliver an update while the database or the Bot API is slow. Re-delivered updates are dropped.
+    During a lazy startup the answer waits until the bot is started: an update is only acknowledged once
+    it will be processed, otherwise it is answered with 503 and Telegram delivers it again.
+    """
+    def initialize(self, bot_app, ready):
+        self.bot_app = bot_app
+        self.ready = ready  # Future set to whether the bot started
+
+    async def post(self):
+        if not self.ready.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.ready), STARTUP_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        if not accepting_updates or not self.ready.done() or not self.ready.result():
+            # Starting, failed to start or shutting down, Telegram delivers the update again later
+            self.set_status(503)
+            return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        update_id = data.get('update_id') if isinstance(data, dict) else None
+        if update_id is not None and update_window.seen(update_id):
+            updates_log.info("Dropping update %s, it was delivered before", update_id)
+            DUPLICATE_UPDATES.inc(layer='memory')
+            return
+        update = Update.de_json(data, self.bot_app.bot)
+        self.bot_app.update_queue.put_nowait(update)
+
+def build_application():
+    if MAX_CONCURRENT_UPDATES > DB_POOL_MAX_SIZE:
+        logging.warning(f"MAX_CONCURRENT_UPDATES={MAX_CONCURRENT_UPDATES} is larger than the connection pool ({DB_POOL_MAX_SIZE}), updates may wait for connections")
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .updater(None)  # Updates come from our own webhook server
+        .concurrent_updates(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f'{TELEGRAM_API_URL}/bot').base_file_url(f'{TELEGRAM_API_URL}/file/bot')
+    app = builder.build()
+    app.add_handler(CommandHandler('start', start_command))
+    app.add_handler(CommandHandler('language', set_language_command))
+    app.add_handler(CommandHandler('subscribe', subscribe_command))
+    app.add_handler(CommandHandler('info', info_command))
+    app.add_handler(CommandHandler('reload', reload_command))
+    app.add_handler(CommandHandler('broadcast', broadcast_command))
+    app.add_handler(CommandHandler('cancel_broadcast', cancel_broadcast_command))
+    app.add_handler(MessageHandler(filters.TEXT, handle_message))
+    app.add_handler(CallbackQueryHandler(handle_answer_callback, pattern=r'^[as]:'))
+    app.add_error_handler(error)
+    return app
+
+async def serve(app, register_webhook=True, reuse_port=False):
+    """
+    Run the bot behind the webhook endpoint until SIGTERM or SIGINT.
+    :param app: The Application with its handlers registered.
+    :param register_webhook: Whether to call set_webhook (only one worker needs to).
+    :param reuse_port: Let several worker processes listen on the same port.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    timer = StartupTimer()
+    ready = loop.create_future()
+    server = HTTPServer(tornado.web.Application(
+        [
+            (rf'{WEBHOOK_PATH}/?', WebhookHandler, {'bot_app': app, 'ready': ready}),
+            (r'/metrics', MetricsHandler),
+        ],
+        log_function=lambda handler: None,  # No access log for every update
+    ))
+    if LAZY_STARTUP:
+        # Heroku routes to the dyno right away, the webhook calls wait until the application is started
+        listen(server, reuse_port)
+    try:
+        try:
+            await start_bot(app, register_webhook, timer)
+        except Exception:
+            # Answer the waiting webhook calls with 503 before exiting, so Telegram delivers those updates again
+            ready.set_result(False)
+            server.stop()
+            try:
+                await asyncio.wait_for(server.close_all_connections(), 5)
+            except asyncio.TimeoutError:
+                pass
+            raise
+        ready.set_result(True)
+        if not LAZY_STARTUP:
+            listen(server, reuse_port)
+        timer.report()
+        run_in_background(warm_question_cache(), name='warm-question-cache')
+        metrics_task = asyncio.create_task(report_state_metrics())
+        activity_task = asyncio.create_task(activity.run())
+        progress_task = asyncio.create_task(progress_writer.run()) if progress_writer.enabled else None
+        await stop.wait()
+
+        metrics_task.cancel()
+        activity_task.cancel()
+        if progress_task:
+            progress_task.cancel()
+        await drain_and_stop(app, server)
+    finally:
+        await app.shutdown()
+
+def listen(server, reuse_port):
+    server.add_sockets(bind_sockets(PORT, address='0.0.0.0', reuse_port=reuse_port))
+    logging.info(f'Listening for webhook updates on port {PORT} (pid {os.getpid()})')
+
+async def start_bot(app, register_webhook, timer):
+    """Connect to the database and to Telegram, then start processing the queued updates."""
+    global postgres_pool, state_store
+    with timer.phase('migrations'):
+        await run_migrations()
+    with timer.phase('state store'):
+        state_store = await create_state_store()
+    if PROGRESS_WRITE_BEHIND:
+        if state_store.shared:
+            logging.warning("PROGRESS_WRITE_BEHIND needs a per-process state store, writing progress through instead")
+        else:
+            # Before the pool is created, its connections only get the staging table when this is on
+            progress_writer.enabled = True
+    with timer.phase('pool'):
+        postgres_pool = await create_pool()
+        if postgres_pool is None:
+            raise RuntimeError("Could not create the database connection pool")
+    with timer.phase('translations'):
+        load_translations()
+    with timer.phase('bot'):
+        await app.initialize()
+    if register_webhook:
+        if LAZY_STARTUP:
+            # Updates already reach us when the webhook is up to date, so do not wait for the check
+            run_in_background(set_webhook(app.bot), name='set-webhook')
+        else:
+            with timer.phase('webhook'):
+                await set_webhook(app.bot)
+    with timer.phase('start'):
+        await app.start()
+    run_in_background(resume_broadcasts(app.bot), name='resume-broadcasts')
+
+def run_worker(register_webhook=True, reuse_port=False):
+    asyncio.run(serve(build_application(), register_webhook, reuse_port))
+
+async def register_webhook_once():
+    bot = build_application().bot
+    async with bot:
+        await set_webhook(bot)
+
+def run_workers(count):
+    # Start the workers sharing the port and register the webhook once
+    if not LAZY_STARTUP:
+        asyncio.run(register_webhook_once())
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(False, True), name=f'worker-{i}') for i in range(count)]
+    for worker in workers:
+        worker.start()
+    if LAZY_STARTUP:
+        try:
+            asyncio.run(register_webhook_once())
+        except Exception as e:
+            logging.error(f"Failed to register the webhook: {e}")
+
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
 
 # Registering commands and message handlers
 if __name__ == '__main__':
     try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:  # 'RuntimeError: no running event loop'
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    postgres_pool = loop.run_until_complete(create_pool())
-    try:
-        app = Application.builder().token(TOKEN).build()
-        # Set up the webhook
-        # asyncio.run(set_webhook(app))
-        loop.run_until_complete(set_webhook(app))
-        # postgres_pool = asyncio.get_event_loop().run_until_complete(create_pool())
-        app.add_handler(CommandHandler('start', start_command))
-        app.add_handler(CommandHandler('language', set_language_command))
-        app.add_handler(CommandHandler('subscribe', subscribe_command))
-        app.add_handler(CommandHandler('info', info_command))
-        app.add_handler(MessageHandler(filters.TEXT, handle_message))
-        app.add_error_handler(error)
         # Start the server with webhook configuration
-        print('Starting the application with webhook configuration...')
-        app.run_webhook(listen="0.0.0.0",
-                        port=int(os.environ.get('PORT', '8443')),
-                        url_path='webhook'+'/'+secure_path,  # Use the secure path
-                        webhook_url=WEBHOOK_URL)
+        logging.info('Starting the application with webhook configuration')
+        if BOT_WORKERS > 1:
+            if STATE_BACKEND == 'memory':
+                logging.warning("STATE_BACKEND=memory is not shared between workers, use postgres or redis")
+            run_workers(BOT_WORKERS)
+        else:
+            run_worker()
     except Exception as e:
-        logging.error(f"Error starting the application: {e}")
\ No newline at end of file
+        logging.error(f"Error starting the application: {e}")
@@ -0,0 +1,54 @@
+-- The schema from README.md, for new databases. Existing databases already have these tables.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'question_type') THEN
+        CREATE TYPE question_type AS ENUM ('Technical', 'Situation', 'Tool', 'Process');
+    END IF;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS questions (
+    id SERIAL PRIMARY KEY,
+    type question_type NOT NULL,
+    section TEXT NOT NULL,
+    text TEXT NOT NULL,
+    text_ru TEXT
+);
+
+CREATE TABLE IF NOT EXISTS answers (
+    id SERIAL PRIMARY KEY,
+    question_id INTEGER REFERENCES questions(id) ON DELETE CASCADE,
+    text TEXT NOT NULL,
+    is_correct BOOLEAN NOT NULL,
+    explanation TEXT,
+    text_ru TEXT,
+    explanation_ru TEXT
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    user_id SERIAL PRIMARY KEY,
+    chat_id BIGINT UNIQUE NOT NULL,
+    language VARCHAR(10) DEFAULT 'en'
+);
+
+CREATE TABLE IF NOT EXISTS user_progress (
+    user_id INT,
+    section VARCHAR(50),
+    current_index INT,
+    correct_answers INT DEFAULT 0,
+    incorrect_answers INT DEFAULT 0,
+    skipped_questions INT DEFAULT 0,
+    CONSTRAINT fk_user FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS user_details (
+    user_id INT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+    first_name VARCHAR(255),
+    last_name VARCHAR(255),
+    username VARCHAR(255),
+    language_code VARCHAR(10),
+    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_active_date TIMESTAMP,
+    email VARCHAR(255),
+    subscribed BOOLEAN DEFAULT FALSE
+);
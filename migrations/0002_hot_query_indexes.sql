@@ -0,0 +1,30 @@
+-- ON CONFLICT (user_id, section) and record_answer need one progress row per user and section.
+-- Databases created from README.md may not have it yet, so keep only one row of any duplicates first.
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indrelid = 'user_progress'::regclass AND i.indisunique
+          AND i.indnkeyatts = 2
+          AND i.indkey[0] = (SELECT attnum FROM pg_attribute WHERE attrelid = 'user_progress'::regclass AND attname = 'user_id')
+          AND i.indkey[1] = (SELECT attnum FROM pg_attribute WHERE attrelid = 'user_progress'::regclass AND attname = 'section')
+    ) THEN
+        DELETE FROM user_progress p
+        USING user_progress newer
+        WHERE p.user_id = newer.user_id AND p.section = newer.section AND p.ctid < newer.ctid;
+        CREATE UNIQUE INDEX user_progress_user_id_section_key ON user_progress (user_id, section);
+    END IF;
+END
+$$;
+
+-- chat_id -> user_id/language without visiting the heap (load_session and the user_id subqueries)
+CREATE UNIQUE INDEX IF NOT EXISTS users_chat_id_covering_idx ON users (chat_id) INCLUDE (user_id, language);
+
+-- The active quiz of a user (load_session)
+CREATE INDEX IF NOT EXISTS user_progress_active_idx ON user_progress (user_id)
+    INCLUDE (section, current_index, correct_answers, incorrect_answers, skipped_questions)
+    WHERE current_index IS NOT NULL;
+
+-- fetch_questions: the questions of a section in id order, and their answers in id order
+CREATE INDEX IF NOT EXISTS questions_section_id_idx ON questions (section, id);
+CREATE INDEX IF NOT EXISTS answers_question_id_id_idx ON answers (question_id, id);
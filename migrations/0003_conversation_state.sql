@@ -0,0 +1,11 @@
+-- Conversation state shared by all workers (STATE_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS conversation_state (
+    chat_id BIGINT NOT NULL,
+    key VARCHAR(50) NOT NULL,
+    value JSONB NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (chat_id, key)
+);
+
+-- Purging expired state
+CREATE INDEX IF NOT EXISTS conversation_state_updated_at_idx ON conversation_state (updated_at);
@@ -0,0 +1,8 @@
+-- One row per import of the question bank (question_bank.py). The highest version is part of the
+-- content version the question cache checks, so in-place edits of questions and answers invalidate it too.
+CREATE TABLE IF NOT EXISTS question_bank_version (
+    version BIGSERIAL PRIMARY KEY,
+    imported_at TIMESTAMP DEFAULT NOW(),
+    source TEXT,
+    questions INT
+);
@@ -0,0 +1,22 @@
+-- Announcements sent to the subscribed users by /broadcast
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id SERIAL PRIMARY KEY,
+    text TEXT NOT NULL,
+    created_by BIGINT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    status VARCHAR(20) NOT NULL DEFAULT 'running',  -- running, done or cancelled
+    last_user_id INT NOT NULL DEFAULT 0,  -- Checkpoint: recipients are sent to in user_id order
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    finished_at TIMESTAMP
+);
+
+-- Delivery status per recipient: sent, blocked (the user blocked the bot) or failed
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    broadcast_id INT NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+    user_id INT NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    error TEXT,
+    sent_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (broadcast_id, user_id)
+);
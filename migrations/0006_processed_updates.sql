@@ -0,0 +1,8 @@
+-- Update ids claimed by a worker, so a webhook delivery retried by Telegram is processed once (STATE_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    received_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Purging old update ids
+CREATE INDEX IF NOT EXISTS processed_updates_received_at_idx ON processed_updates (received_at);
@@ -0,0 +1,317 @@
+"""
+Import and export the question bank.
+
+    python question_bank.py import questions.jsonl            # diff-merge the sections in the file
+    python question_bank.py import questions.csv --replace    # replace the sections in the file
+    python question_bank.py export questions.jsonl [--section QAJ]
+
+JSONL: one question per line,
+    {"section": "QAJ", "type": "Process", "text": "...", "text_ru": "...",
+     "answers": [{"text": "...", "text_ru": "...", "is_correct": true, "explanation": "...", "explanation_ru": "..."}]}
+CSV: one answer per row, consecutive rows with the same section and question form one question, with the header
+    section,type,question,question_ru,answer,answer_ru,is_correct,explanation,explanation_ru
+
+The file is copied into temporary staging tables with COPY and merged in one transaction, so users keep using the
+bot while a bank is loaded and never see a half imported one. Only the sections present in the file are changed.
+By default questions are matched by section and English text: matched questions keep their id (and so their place
+in the section), their answers are only rewritten when they changed, new questions are added at the end of their
+section and questions missing from the file are deleted. Users after a deleted question are moved back so they stay
+on the same question, and users past the end of a section are reset as if they completed it. --replace deletes and
+re-inserts the sections instead.
+Every import records a new version in question_bank_version, which drops the bot's question cache within
+QUESTION_CACHE_CHECK_INTERVAL (or right away with /reload).
+"""
+import argparse, asyncio, csv, json, os, sys, time
+from contextlib import nullcontext
+
+import asyncpg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+QUESTION_TYPES = ('Technical', 'Situation', 'Tool', 'Process')
+CSV_COLUMNS = ['section', 'type', 'question', 'question_ru', 'answer', 'answer_ru', 'is_correct', 'explanation',
+               'explanation_ru']
+
+STAGING_TABLES = """
+    CREATE TEMP TABLE import_questions (
+        pos INT PRIMARY KEY, section TEXT NOT NULL, type TEXT NOT NULL, text TEXT NOT NULL, text_ru TEXT
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE import_answers (
+        question_pos INT NOT NULL, pos INT NOT NULL, text TEXT NOT NULL, text_ru TEXT,
+        is_correct BOOLEAN NOT NULL, explanation TEXT, explanation_ru TEXT
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE question_map (pos INT PRIMARY KEY, id INT, is_new BOOLEAN NOT NULL) ON COMMIT DROP;
+"""
+
+# Staged question -> existing question id (NULL for new ones), matched on section and text unless replacing
+MATCH_QUESTIONS = """
+    INSERT INTO question_map (pos, id, is_new)
+    SELECT DISTINCT ON (s.pos) s.pos, q.id, q.id IS NULL AS is_new
+    FROM import_questions s
+    LEFT JOIN questions q ON q.section = s.section AND q.text = s.text AND NOT $1
+    ORDER BY s.pos, q.id
+"""
+
+# user_progress.current_index is a position in the section's questions (with answers) ordered by id, as the bot
+# loads them. The positions of the questions about to be deleted are kept to move the users after them back.
+DELETED_POSITIONS = """
+    CREATE TEMP TABLE deleted_positions ON COMMIT DROP AS
+    SELECT r.section, r.pos
+    FROM (
+        SELECT q.id, q.section, row_number() OVER (PARTITION BY q.section ORDER BY q.id) - 1 AS pos
+        FROM questions q
+        WHERE q.section IN (SELECT DISTINCT section FROM import_questions)
+          AND EXISTS (SELECT 1 FROM answers a WHERE a.question_id = q.id)
+    ) r
+    WHERE NOT EXISTS (SELECT 1 FROM question_map m WHERE m.id = r.id)
+"""
+
+# A user on a deleted question stays at the same position, which is now the question after it
+SHIFT_PROGRESS = """
+    UPDATE user_progress p
+    SET current_index = p.current_index - d.deleted
+    FROM (
+        SELECT p.user_id, p.section, count(*) AS deleted
+        FROM user_progress p
+        JOIN deleted_positions d ON d.section = p.section AND d.pos < p.current_index
+        GROUP BY p.user_id, p.section
+    ) d
+    WHERE p.user_id = d.user_id AND p.section = d.section
+"""
+
+# Past the end of the section now: completed, like the bot does after the last question
+END_PROGRESS = """
+    UPDATE user_progress p
+    SET current_index = NULL, correct_answers = 0, incorrect_answers = 0, skipped_questions = 0
+    FROM (SELECT section, count(*) AS questions FROM import_questions GROUP BY section) s
+    WHERE p.section = s.section AND p.current_index >= s.questions
+"""
+
+DELETE_MISSING = """
+    DELETE FROM questions q
+    WHERE q.section IN (SELECT DISTINCT section FROM import_questions)
+      AND NOT EXISTS (SELECT 1 FROM question_map m WHERE m.id = q.id)
+"""
+
+UPDATE_MATCHED = """
+    UPDATE questions q
+    SET type = s.type::question_type, text_ru = s.text_ru
+    FROM import_questions s
+    JOIN question_map m ON m.pos = s.pos
+    WHERE q.id = m.id AND (q.type::text, q.text_ru) IS DISTINCT FROM (s.type, s.text_ru)
+"""
+
+INSERT_NEW = """
+    WITH inserted AS (
+        INSERT INTO questions (type, section, text, text_ru)
+        SELECT s.type::question_type, s.section, s.text, s.text_ru
+        FROM import_questions s
+        JOIN question_map m ON m.pos = s.pos
+        WHERE m.is_new
+        ORDER BY s.pos
+        RETURNING id, section, text
+    )
+    UPDATE question_map m SET id = i.id
+    FROM inserted i
+    JOIN import_questions s ON s.section = i.section AND s.text = i.text
+    WHERE m.pos = s.pos
+"""
+
+# Questions whose answers differ from the file (all new questions)
+CHANGED_ANSWERS = """
+    CREATE TEMP TABLE changed_questions ON COMMIT DROP AS
+    SELECT m.pos, m.id
+    FROM question_map m
+    WHERE m.is_new
+       OR (SELECT array_agg(row(a.text, a.text_ru, a.is_correct, a.explanation, a.explanation_ru)::text ORDER BY a.id)
+           FROM answers a WHERE a.question_id = m.id)
+          IS DISTINCT FROM
+          (SELECT array_agg(row(s.text, s.text_ru, s.is_correct, s.explanation, s.explanation_ru)::text ORDER BY s.pos)
+           FROM import_answers s WHERE s.question_pos = m.pos)
+"""
+
+REPLACE_ANSWERS = """
+    DELETE FROM answers WHERE question_id IN (SELECT id FROM changed_questions);
+    INSERT INTO answers (question_id, text, text_ru, is_correct, explanation, explanation_ru)
+    SELECT c.id, s.text, s.text_ru, s.is_correct, s.explanation, s.explanation_ru
+    FROM import_answers s
+    JOIN changed_questions c ON c.pos = s.question_pos
+    ORDER BY s.question_pos, s.pos;
+"""
+
+EXPORT_QUERY = """
+    SELECT q.id, q.section, q.type::text AS type, q.text, q.text_ru,
+           a.text AS answer, a.text_ru AS answer_ru, a.is_correct, a.explanation, a.explanation_ru
+    FROM questions q
+    JOIN answers a ON a.question_id = q.id
+    WHERE $1::text IS NULL OR q.section = $1
+    ORDER BY q.section, q.id, a.id
+"""
+
+class BankFormatError(ValueError):
+    """The file is not a valid question bank."""
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true', 't', 'yes', 'y'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', 'f', 'no', 'n', ''):
+        return False
+    raise BankFormatError(f"Not a boolean: {value!r}")
+
+def read_jsonl(path):
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise BankFormatError(f"{path}:{line_number}: {e}")
+            yield line_number, item
+
+def read_csv(path):
+    # Consecutive rows of the same question are grouped into one item with its answers
+    with open(path, encoding='utf-8', newline='') as f:
+        reader = csv.DictReader(f)
+        item = item_line = None
+        for row in reader:
+            key = (row['section'], row['question'])
+            if item is None or (item['section'], item['text']) != key:
+                if item is not None:
+                    yield item_line, item
+                item_line = reader.line_num
+                item = {'section': row['section'], 'type': row['type'], 'text': row['question'],
+                        'text_ru': row.get('question_ru') or None, 'answers': []}
+            item['answers'].append({'text': row['answer'], 'text_ru': row.get('answer_ru') or None,
+                                    'is_correct': row['is_correct'], 'explanation': row.get('explanation') or None,
+                                    'explanation_ru': row.get('explanation_ru') or None})
+        if item is not None:
+            yield item_line, item
+
+def read_bank(path):
+    """
+    Read and validate a JSONL or CSV file.
+    :return: The question records and answer records for the staging tables.
+    """
+    items = read_csv(path) if path.lower().endswith('.csv') else read_jsonl(path)
+    questions, answers, seen = [], [], set()
+    for pos, (line, item) in enumerate(items):
+        where = f"{path}:{line}"
+        if not item.get('section') or not item.get('text'):
+            raise BankFormatError(f"{where}: section and text are required")
+        if item.get('type') not in QUESTION_TYPES:
+            raise BankFormatError(f"{where}: type must be one of {', '.join(QUESTION_TYPES)}")
+        if (item['section'], item['text']) in seen:
+            raise BankFormatError(f"{where}: duplicate question in section {item['section']}")
+        if not item.get('answers'):
+            raise BankFormatError(f"{where}: a question needs at least one answer")
+        seen.add((item['section'], item['text']))
+        questions.append((pos, item['section'], item['type'], item['text'], item.get('text_ru')))
+        for answer_pos, answer in enumerate(item['answers']):
+            answers.append((pos, answer_pos, answer['text'], answer.get('text_ru'), parse_bool(answer['is_correct']),
+                            answer.get('explanation'), answer.get('explanation_ru')))
+    return questions, answers
+
+def database_ssl(dsn):
+    # Heroku requires SSL connections, a local database is used without
+    return 'require' if "localhost" not in dsn else False
+
+async def connect():
+    """A single connection to DATABASE_URL, for the tools and the jobs that do not use the pool."""
+    return await asyncpg.connect(dsn=os.environ['DATABASE_URL'], ssl=database_ssl(os.environ['DATABASE_URL']))
+
+async def import_bank(path, replace=False, dry_run=False):
+    started = time.monotonic()
+    questions, answers = read_bank(path)
+    conn = await connect()
+    try:
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            await conn.execute(STAGING_TABLES)
+            await conn.copy_records_to_table('import_questions', records=questions)
+            await conn.copy_records_to_table('import_answers', records=answers)
+            await conn.execute(MATCH_QUESTIONS, replace)
+            await conn.execute(DELETED_POSITIONS)
+            moved = int((await conn.execute(SHIFT_PROGRESS)).split()[-1])
+            deleted = int((await conn.execute(DELETE_MISSING)).split()[-1])
+            updated = int((await conn.execute(UPDATE_MATCHED)).split()[-1])
+            inserted = await conn.fetchval("SELECT count(*) FROM question_map WHERE is_new")
+            await conn.execute(INSERT_NEW)
+            await conn.execute(CHANGED_ANSWERS)
+            changed = await conn.fetchval("SELECT count(*) FROM changed_questions c JOIN question_map m USING (pos) WHERE NOT m.is_new")
+            await conn.execute(REPLACE_ANSWERS)
+            ended = int((await conn.execute(END_PROGRESS)).split()[-1])
+            version = await conn.fetchval(
+                "INSERT INTO question_bank_version (source, questions) VALUES ($1, $2) RETURNING version",
+                os.path.basename(path), len(questions))
+        except Exception:
+            await transaction.rollback()
+            raise
+        if dry_run:
+            await transaction.rollback()
+        else:
+            await transaction.commit()
+    finally:
+        await conn.close()
+    print(f"{'Would import' if dry_run else 'Imported'} {len(questions)} questions and {len(answers)} answers "
+          f"from {path} in {time.monotonic() - started:.1f} s: {inserted} added, {deleted} deleted, "
+          f"{updated} updated, answers rewritten for {changed}; {moved} users moved back, {ended} users past the end")
+    if not dry_run:
+        print(f"Question bank version {version}")
+    return version
+
+async def export_bank(path, section=None):
+    conn = await connect()
+    try:
+        as_csv = path.lower().endswith('.csv')
+        with open(path, 'w', encoding='utf-8', newline='') if path != '-' else nullcontext(sys.stdout) as f:
+            writer = csv.writer(f) if as_csv else None
+            if as_csv:
+                writer.writerow(CSV_COLUMNS)
+            item, count = None, 0
+            async with conn.transaction():
+                # A server side cursor, so large banks are not loaded into memory at once
+                async for row in conn.cursor(EXPORT_QUERY, section, prefetch=1000):
+                    if as_csv:
+                        writer.writerow([row['section'], row['type'], row['text'], row['text_ru'], row['answer'],
+                                         row['answer_ru'], row['is_correct'], row['explanation'], row['explanation_ru']])
+                    if item is None or item['id'] != row['id']:
+                        if item is not None and not as_csv:
+                            f.write(json.dumps({k: v for k, v in item.items() if k != 'id'}, ensure_ascii=False) + '\n')
+                        item = {'id': row['id'], 'section': row['section'], 'type': row['type'], 'text': row['text'],
+                                'text_ru': row['text_ru'], 'answers': []}
+                        count += 1
+                    item['answers'].append({'text': row['answer'], 'text_ru': row['answer_ru'],
+                                            'is_correct': row['is_correct'], 'explanation': row['explanation'],
+                                            'explanation_ru': row['explanation_ru']})
+            if item is not None and not as_csv:
+                f.write(json.dumps({k: v for k, v in item.items() if k != 'id'}, ensure_ascii=False) + '\n')
+    finally:
+        await conn.close()
+    print(f"Exported {count} questions to {path}", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='Load a JSONL or CSV file into the database')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--replace', action='store_true', help='Replace the sections instead of merging')
+    import_parser.add_argument('--dry-run', action='store_true', help='Report the changes and roll them back')
+    export_parser = commands.add_parser('export', help='Write the question bank to a JSONL or CSV file (- for stdout)')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--section', help='Only export this section, e.g. QAJ')
+    args = parser.parse_args()
+    try:
+        if args.command == 'import':
+            asyncio.run(import_bank(args.path, args.replace, args.dry_run))
+        else:
+            asyncio.run(export_bank(args.path, args.section))
+    except BankFormatError as e:
+        sys.exit(f"Invalid question bank: {e}")
+
+if __name__ == '__main__':
+    main()
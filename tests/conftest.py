@@ -0,0 +1,6 @@
+import os, sys
+
+# main.py reads these on import; no database or Telegram connection is made by the tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('TOKEN', '123456:test')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/test')
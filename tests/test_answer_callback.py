@@ -0,0 +1,32 @@
+"""Callback data of the inline quiz mode."""
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+def test_parse_answer_callback():
+    assert main.parse_answer_callback('a:12:34') == ('a', 12, 34)
+    assert main.parse_answer_callback('s:12') == ('s', 12, None)
+    for data in ('a:12', 'a:12:', 'a:x:1', 's:', 's:1:2', 'a:1:2:3', '', None):
+        assert main.parse_answer_callback(data) is None, data
+
+def answered(data, message):
+    answers = []
+
+    async def answer_callback(query, text=None):
+        answers.append(text)
+
+    query = SimpleNamespace(id='1', data=data, message=message, from_user=SimpleNamespace(language_code='en'))
+    update = SimpleNamespace(callback_query=query)
+    original, main.answer_callback = main.answer_callback, answer_callback
+    try:
+        asyncio.run(main.handle_answer_callback(update, None))
+    finally:
+        main.answer_callback = original
+    return answers
+
+def test_inaccessible_message_is_answered():
+    assert answered('a:1:2', None) == ["This question is no longer active."]
+
+def test_malformed_data_is_answered():
+    assert answered('a:1', SimpleNamespace(chat_id=1, message_id=1)) == ["This question is no longer active."]
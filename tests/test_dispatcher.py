@@ -0,0 +1,78 @@
+"""
+Per-answer latency of the outbound dispatcher against the fake Bot API of loadtest.py.
+Run with `python -m pytest tests`.
+"""
+import asyncio, os, time
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from telegram import Bot
+
+import main
+from loadtest import FakeBotApi, FakeBotApiHandler
+
+CHAT_ID = 42
+# The buckets refill SCALE times faster and the user thinks SCALE times faster, so the test runs in a fraction of the time
+SCALE = 5
+THINK_TIME = 2.0  # Seconds a user takes to read the explanation and the next question before answering
+
+async def answer(bot):
+    # The Bot API calls of one reply-mode answer in handle_quiz, with the default coalesced separator
+    main.flash_message(bot, CHAT_ID, "🌟\n", duration=0.5 / SCALE)
+    await main.send_message(bot, CHAT_ID, "🌟 Correct!\n\nExplanation")
+    question = f"{main.QUESTION_SEPARATOR}\n\n🧩 Question?" if main.COALESCE_QUESTION_SEPARATOR else "🧩 Question?"
+    if not main.COALESCE_QUESTION_SEPARATOR:
+        await main.send_message(bot, CHAT_ID, main.QUESTION_SEPARATOR, parse_mode='HTML')
+    await main.send_message(bot, CHAT_ID, question, parse_mode='HTML')
+
+class CountingBucket(main.TokenBucket):
+    """Counts the acquires that had to wait for a token. Slow HTTP calls only leave more time to refill."""
+    waits = 0
+
+    async def acquire(self):
+        self._refill()
+        if self.tokens < 1:
+            CountingBucket.waits += 1
+        await super().acquire()
+
+async def send_answers(answers):
+    api = FakeBotApi()
+    sock, port = bind_unused_port()
+    server = HTTPServer(tornado.web.Application([(r'/bot([^/]+)/(\w+)', FakeBotApiHandler, {'api': api})]))
+    server.add_sockets([sock])
+    main.dispatcher = main.MessageDispatcher(main.GLOBAL_SEND_RATE * SCALE, main.CHAT_SEND_RATE * SCALE, main.CHAT_SEND_BURST)
+    bot = Bot(os.environ['TOKEN'], base_url=f'http://127.0.0.1:{port}/bot')
+    try:
+        async with bot:
+            for _ in range(answers):
+                await answer(bot)
+                await asyncio.sleep(THINK_TIME / SCALE)
+            await main.finish_background_tasks()
+    finally:
+        server.stop()
+    return api.calls
+
+def test_quick_answers_are_not_held_back_by_the_chat_limit(monkeypatch):
+    monkeypatch.setattr(main, 'TokenBucket', CountingBucket)
+    monkeypatch.setattr(CountingBucket, 'waits', 0)
+    calls = asyncio.run(send_answers(8))
+    assert CountingBucket.waits == 0
+    assert calls['deleteMessage'] == 8
+
+def test_deleting_a_message_does_not_use_a_chat_token():
+    async def run():
+        dispatcher = main.MessageDispatcher(1000, 1, 1)
+
+        async def send_message(**kwargs):
+            return kwargs
+
+        async def delete_message(**kwargs):
+            return True
+
+        started = time.monotonic()
+        await dispatcher.send(CHAT_ID, send_message, chat_id=CHAT_ID, text='hi')
+        await dispatcher.send(CHAT_ID, delete_message, chat_id=CHAT_ID, message_id=1)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 0.5
@@ -0,0 +1,12 @@
+"""Answer keyboards of the reply quiz mode."""
+import main
+
+def rows(markup):
+    return [[button.text for button in row] for row in markup.keyboard]
+
+def test_answer_keyboard_with_one_or_two_answers():
+    assert rows(main.build_answer_keyboard(['a1'], 'skip')) == [['a1', 'skip']]
+    assert rows(main.build_answer_keyboard(['a1', 'a2'], 'skip')) == [['a1', 'a2'], ['skip']]
+
+def test_answer_keyboard_with_three_answers():
+    assert rows(main.build_answer_keyboard(['a1', 'a2', 'a3'], 'skip')) == [['a1', 'a2'], ['a3', 'skip']]
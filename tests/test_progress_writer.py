@@ -0,0 +1,45 @@
+"""Write-behind of the quiz progress."""
+import asyncio
+from contextlib import asynccontextmanager
+
+import main
+
+class SlowConnection:
+    def __init__(self, started):
+        self.started = started
+
+    def transaction(self):
+        @asynccontextmanager
+        async def transaction():
+            yield
+        return transaction()
+
+    async def copy_records_to_table(self, table, records):
+        self.started.set()
+        await asyncio.sleep(0.1)
+
+    async def execute(self, query, *args):
+        pass
+
+def test_a_session_loaded_during_a_flush_gets_the_rows_being_written(monkeypatch):
+    async def run():
+        started = asyncio.Event()
+
+        @asynccontextmanager
+        async def db_connection():
+            yield SlowConnection(started)
+
+        monkeypatch.setattr(main, 'db_connection', db_connection)
+        writer = main.ProgressWriter()
+        session = main.Session(chat_id=1, user_id=7, section='QAJ', index=3, correct=2)
+        writer.record_answer(session, 'QAJ', 10, 'correct')
+        flush = asyncio.create_task(writer.flush())
+        await started.wait()
+        # Loaded from the database while the flush has not committed yet
+        reloaded = main.Session(chat_id=1, user_id=7, section='QAJ', index=3, correct=2)
+        writer.apply_pending(reloaded)
+        await flush
+        return reloaded
+
+    reloaded = asyncio.run(run())
+    assert (reloaded.index, reloaded.correct) == (4, 3)
@@ -0,0 +1,63 @@
+"""Ordering and concurrency of ChatOrderedUpdateProcessor."""
+import asyncio, time
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update
+
+import main
+
+def make_update(update_id, chat_id):
+    chat = Chat(chat_id, Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(timezone.utc), chat, text='hi'))
+
+def test_a_busy_chat_does_not_hold_the_slots_of_other_chats():
+    async def run():
+        processor = main.ChatOrderedUpdateProcessor(3)
+        finished = {}
+        started = time.monotonic()
+
+        async def handle(update_id, duration):
+            await asyncio.sleep(duration)
+            finished[update_id] = time.monotonic() - started
+
+        tasks = [asyncio.create_task(processor.process_update(make_update(i, 1), handle(i, 0.2))) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(make_update(3, 2), handle(3, 0))))
+        await asyncio.gather(*tasks)
+        return finished
+
+    finished = asyncio.run(run())
+    assert finished[3] < 0.1, finished
+    # The updates of chat 1 ran one after another, in order
+    assert finished[0] < finished[1] < finished[2]
+    assert finished[2] >= 0.6
+
+def test_updates_still_running_are_dropped_on_shutdown():
+    async def run():
+        processor = main.ChatOrderedUpdateProcessor(2)
+        tasks = [asyncio.create_task(processor.process_update(make_update(i, 1), asyncio.sleep(10))) for i in range(2)]
+        await asyncio.sleep(0.05)
+        processor.drop_remaining()
+        await asyncio.gather(*tasks)
+        return processor
+
+    processor = asyncio.run(run())
+    assert sorted(processor.dropped) == [0, 1]
+    assert processor.processed == 0
+
+def test_no_more_than_max_concurrent_updates_run_at_once():
+    async def run():
+        processor = main.ChatOrderedUpdateProcessor(2)
+        running = peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(i, i), handle()) for i in range(5)))
+        return peak, processor.processed
+
+    assert asyncio.run(run()) == (2, 5)
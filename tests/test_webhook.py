@@ -0,0 +1,42 @@
+"""Acknowledging webhook calls during a lazy startup."""
+import asyncio, json
+from types import SimpleNamespace
+
+import httpx
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+import main
+
+def make_update(update_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'hi'}}
+
+async def post_updates(start, update_ids):
+    """Post the updates while the bot starts, `start` sets the ready future. Returns the status codes and the queue."""
+    app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+    ready = asyncio.get_running_loop().create_future()
+    sock, port = bind_unused_port()
+    server = HTTPServer(tornado.web.Application([(r'/webhook', main.WebhookHandler, {'bot_app': app, 'ready': ready})]))
+    server.add_sockets([sock])
+    try:
+        async with httpx.AsyncClient() as client:
+            posts = [asyncio.create_task(client.post(f'http://127.0.0.1:{port}/webhook', content=json.dumps(make_update(i))))
+                     for i in update_ids]
+            await asyncio.sleep(0.1)
+            start(ready)
+            responses = await asyncio.gather(*posts)
+    finally:
+        server.stop()
+    return [response.status_code for response in responses], app.update_queue
+
+def test_updates_are_acknowledged_once_the_bot_started():
+    statuses, update_queue = asyncio.run(post_updates(lambda ready: ready.set_result(True), [101, 102]))
+    assert statuses == [200, 200]
+    assert update_queue.qsize() == 2
+
+def test_updates_are_refused_when_the_startup_fails():
+    statuses, update_queue = asyncio.run(post_updates(lambda ready: ready.set_result(False), [201, 202]))
+    assert statuses == [503, 503]
+    assert update_queue.qsize() == 0